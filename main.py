@@ -2,21 +2,52 @@
 """
 Voice Clone Userbot with Real-time Voice Modification
 Supports character voices: Jokowi, Squidward, SpongeBob, Ganjar, Clara
+and convolution effects: Room, Radio, Phone, Megaphone
 """
 
 import os
 import sys
 import asyncio
 import threading
+import time
 import numpy as np
-import sounddevice as sd
-from scipy.signal import resample, butter, filtfilt
+from scipy.signal import butter, sosfilt, firwin
+from scipy.io import wavfile
+from numpy.lib.stride_tricks import sliding_window_view
 import logging
 from pyrogram import Client, filters
 from pyrogram.errors import SessionPasswordNeeded, PhoneCodeInvalid, PhoneNumberInvalid
+import io
 import json
+import hashlib
+import argparse
+import atexit
+import bisect
+import multiprocessing
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from abc import ABC, abstractmethod
+from collections import OrderedDict, namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 
+try:
+    import sounddevice as sd
+except (ImportError, OSError):  # No PortAudio (headless box): offline tools still work
+    sd = None
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11: JSON character files only
+    tomllib = None
+
+try:
+    import numba
+except ImportError:  # Optional JIT kernels; NumPy implementations are used instead
+    numba = None
+
 # ================================
 # ENVIRONMENT CONFIGURATION
 # ================================
@@ -31,264 +62,4108 @@ class Config:
     SAMPLE_RATE = 44100
     BUFFER_SIZE = 1024
     
+    # Block size / latency auto-tuning (BUFFER_SIZE is used when disabled)
+    AUTO_TUNE = True
+    BLOCK_SIZE_CANDIDATES = (128, 256, 512, 1024, 2048)
+    TUNE_TARGET_LOAD = 0.5          # p99 callback time / block period
+    TUNE_LATENCY_BLOCKS = (1, 2, 4)  # stream latency steps, in blocks
+    TUNE_INTERVAL = 2.0
+    TUNE_RELAX_WINDOWS = 30
+    
+    # Channels: "mono" downmixes once and feeds every output channel,
+    # "stereo" processes each channel with its own filter state
+    CHANNELS = 1
+    CHANNEL_MODE = "mono"
+    AUDIO_DEVICE = None  # sounddevice device name/index for the duplex stream (None = default)
+    
+    # Formant warping (frame size / hop in samples, see FormantWarper)
+    FORMANT_FRAME_SIZE = 512
+    FORMANT_HOP_SIZE = 128
+    
+    # Character library (JSON/TOML files, hot-reloaded) and compiled chain cache
+    CHARACTERS_DIR = "characters"
+    CHAIN_CACHE_DIR = ".cache/chains"
+    CHARACTER_WATCH_INTERVAL = 1.0
+    
+    # Raw float32 impulse responses / effect samples (memory-mapped)
+    SAMPLES_DIR = "samples"
+    
+    # Noise gate / voice activity detection in front of the chain
+    GATE_ENABLED = True
+    GATE_OPEN_DB = -45.0
+    GATE_CLOSE_DB = -52.0
+    GATE_HANGOVER_MS = 250
+    GATE_FADE_MS = 10
+    GATE_MAX_ZCR = 0.4
+    
+    # Output sinks: ring of preallocated PCM blocks shared by all sinks
+    SINK_QUEUE_BLOCKS = 32
+    SINK_MAX_BLOCK = 4096
+    
+    # Metrics endpoint (Prometheus text format, local only)
+    METRICS_ENABLED = True
+    METRICS_HOST = "127.0.0.1"
+    METRICS_PORT = 9464
+    LOOP_LAG_INTERVAL = 0.5
+    
+    # `.debug profile`: stack sampling interval and output directory
+    PROFILE_INTERVAL = 0.005
+    PROFILE_DIR = "logs"
+    PROFILE_MAX_SECONDS = 120
+    
+    # `.convert` media pipeline: workers per stage, queue bound, in-memory download limit
+    MEDIA_CONCURRENCY = {"download": 2, "process": 1, "upload": 2}
+    MEDIA_QUEUE_SIZE = 4
+    MEDIA_MEMORY_LIMIT = 20 * 1024 * 1024
+    MEDIA_OPUS_BITRATE = "48k"
+    
+    # Loudness normalization before the output limiter (characters may set target_lufs)
+    TARGET_LUFS = -18.0
+    LOUDNESS_GATE_LUFS = -50.0
+    LOUDNESS_MAX_BOOST_DB = 12.0
+    LOUDNESS_MAX_CUT_DB = 12.0
+    
+    # Per-sample kernels: "auto" uses numba when installed, else NumPy.
+    # --bench-kernels fails when a backend differs from NumPy by more than this
+    KERNEL_BACKEND = "auto"
+    KERNEL_TOLERANCE = 1e-9
+    
+    # WSOLA time-scale modification (pitch shifting and speaking rate)
+    WSOLA_FRAME_SIZE = 1024
+    WSOLA_TOLERANCE = 256
+    WSOLA_ANCHOR_FRAMES = 16
+    STRETCH_TARGET_SECONDS = 0.05
+    STRETCH_MAX_SECONDS = 0.5
+    STRETCH_CATCHUP_RATE = 1.5
+    
+    # `.say`: offline TTS backend, its base pitch and the encoded-phrase cache
+    TTS_BACKEND = "formant"
+    TTS_F0 = 120.0
+    SAY_CACHE_SIZE = 64
+    SAY_MAX_CHARS = 300
+    
+    # Per-user voice profiles (.convert): store path, voiced seconds before the
+    # targets are used / before analysis stops, and the level inputs are brought to
+    VOICE_PROFILES_PATH = ".cache/profiles.bin"
+    VOICE_PROFILE_MIN_SECONDS = 10.0
+    VOICE_PROFILE_MAX_SECONDS = 60.0
+    VOICE_PROFILE_TARGET_DB = -20.0
+    
+    # Offline parallel rendering (--workers)
+    PARALLEL_SEGMENT_SECONDS = 30.0
+    PARALLEL_PREROLL_SECONDS = 1.0
+    PARALLEL_CROSSFADE_SECONDS = 0.05
+    
     # Session Configuration
     SESSION_NAME = "voice_clone_userbot"
     
-    # Voice Characters Database
+    # Tone profiles: stage lists appended to a character's chain
+    TONE_PROFILES = {
+        "neutral": [],
+        # Squidward - emphasize nasal frequencies (1000-2000 Hz)
+        "nasal": [
+            {"type": "filter", "btype": "bandpass", "order": 2, "cutoff": [1000, 2000], "mix": 0.3}
+        ],
+        # SpongeBob - high frequency boost and 5 Hz tremolo
+        "excited": [
+            {"type": "filter", "btype": "highpass", "order": 2, "cutoff": 2000, "mix": 0.2},
+            {"type": "tremolo", "rate_hz": 5.0, "depth": 0.1}
+        ],
+        # Jokowi - low-mid boost for authority
+        "authoritative": [
+            {"type": "filter", "btype": "bandpass", "order": 3, "cutoff": [150, 800], "mix": 0.25}
+        ],
+        # Ganjar - gentle low-frequency warmth
+        "friendly": [
+            {"type": "filter", "btype": "lowpass", "order": 2, "cutoff": 500, "mix": 0.15}
+        ],
+        # Clara - brightness (compression comes from the character's compressor)
+        "energetic": [
+            {"type": "filter", "btype": "highpass", "order": 2, "cutoff": 1500, "mix": 0.2}
+        ],
+    }
+    
+    # Built-in Voice Characters (files in CHARACTERS_DIR add to / override these).
+    # target_centroid is the power-weighted centroid of the voiced envelope that
+    # .profile measures; an average adult voice comes out around 600 Hz.
     VOICE_CHARACTERS = {
         "jokowi": {
             "name": "Joko Widodo",
             "pitch_factor": 0.85,
             "formant_shift": 0.9,
+            "formant_method": "lpc",
             "speaking_rate": 0.9,
+            "target_f0": 115,
+            "target_centroid": 540,
             "tone_profile": "authoritative"
         },
         "squidward": {
             "name": "Squidward Tentacles", 
             "pitch_factor": 0.7,
             "formant_shift": 1.1,
+            "formant_method": "cepstral",
             "speaking_rate": 0.8,
+            "target_f0": 95,
+            "target_centroid": 650,
             "tone_profile": "nasal"
         },
         "spongebob": {
             "name": "SpongeBob SquarePants",
             "pitch_factor": 1.4,
             "formant_shift": 1.3,
+            "formant_method": "cepstral",
             "speaking_rate": 1.2,
+            "target_f0": 260,
+            "target_centroid": 900,
             "tone_profile": "excited"
         },
         "ganjar": {
             "name": "Ganjar Pranowo",
             "pitch_factor": 0.9,
             "formant_shift": 0.95,
+            "formant_method": "lpc",
             "speaking_rate": 1.0,
+            "target_f0": 120,
+            "target_centroid": 580,
             "tone_profile": "friendly"
         },
         "clara": {
             "name": "Clara Mongstar",
             "pitch_factor": 1.2,
             "formant_shift": 1.15,
+            "formant_method": "cepstral",
             "speaking_rate": 1.1,
-            "tone_profile": "energetic"
+            "target_f0": 230,
+            "target_centroid": 820,
+            "tone_profile": "energetic",
+            "compressor": {"threshold_db": -10.5, "ratio": 2.0, "knee_db": 4.0,
+                           "attack_ms": 3.0, "release_ms": 120.0}
+        },
+        "room": {
+            "name": "Small Room",
+            "pitch_factor": 1.0,
+            "formant_shift": 1.0,
+            "speaking_rate": 1.0,
+            "tone_profile": "neutral",
+            "stages": [{"type": "convolution", "impulse_response": "room", "wet": 0.4, "dry": 1.0}]
+        },
+        "radio": {
+            "name": "AM Radio",
+            "pitch_factor": 1.0,
+            "formant_shift": 1.0,
+            "speaking_rate": 1.0,
+            "tone_profile": "neutral",
+            "stages": [{"type": "convolution", "impulse_response": "radio"}],
+            "compressor": {"threshold_db": -18.0, "ratio": 4.0, "makeup_db": 6.0}
+        },
+        "phone": {
+            "name": "Telephone",
+            "pitch_factor": 1.0,
+            "formant_shift": 1.0,
+            "speaking_rate": 1.0,
+            "tone_profile": "neutral",
+            "stages": [{"type": "convolution", "impulse_response": "phone"}]
+        },
+        "megaphone": {
+            "name": "Megaphone",
+            "pitch_factor": 1.0,
+            "formant_shift": 1.0,
+            "speaking_rate": 1.0,
+            "tone_profile": "neutral",
+            "stages": [{"type": "convolution", "impulse_response": "megaphone"}],
+            "compressor": {"threshold_db": -20.0, "ratio": 8.0, "knee_db": 2.0, "makeup_db": 9.0}
+        }
+    }
+
+# ================================
+# METRICS
+# ================================
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    """Monotonic counter; ``fn`` makes it read a value at scrape time instead"""
+
+    kind = "counter"
+
+    def __init__(self, fn=None):
+        self.value = 0.0
+        self.fn = fn
+
+    def inc(self, amount=1.0):
+        self.value += amount
+
+    def sample(self):
+        return self.fn() if self.fn is not None else self.value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    """Fixed-bucket histogram; ``observe`` is a bisect plus two additions"""
+
+    kind = "histogram"
+
+    def __init__(self, buckets):
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class MetricFamily:
+    """A named metric with optional labels; children are created on first use"""
+
+    def __init__(self, name, help_text, factory, label_names=()):
+        self.name = name
+        self.help = help_text
+        self.factory = factory
+        self.kind = factory().kind
+        self.label_names = tuple(label_names)
+        self.children = {}
+        self._lock = threading.Lock()
+        if not self.label_names:
+            # Bind the single child's recording methods directly (hot path)
+            child = self.children[()] = factory()
+            for method in ("inc", "set", "observe"):
+                if hasattr(child, method):
+                    setattr(self, method, getattr(child, method))
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self._lock:
+                child = self.children.setdefault(values, self.factory())
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self.children.items()):
+            if self.kind == "histogram":
+                cumulative = 0
+                for bound, count in zip(self.bounds_of(child), child.counts):
+                    cumulative += count
+                    le = "+Inf" if bound is None else repr(bound)
+                    labels = _format_labels(self.label_names, values, [("le", le)])
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.label_names, values)
+                lines.append(f"{self.name}_sum{labels} {child.sum}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+            else:
+                try:
+                    value = child.sample()
+                except Exception:
+                    continue
+                lines.append(f"{self.name}{_format_labels(self.label_names, values)} {value}")
+        return lines
+
+    @staticmethod
+    def bounds_of(child):
+        return list(child.bounds) + [None]
+
+
+class MetricsRegistry:
+    """Process-wide metrics in Prometheus text exposition format
+
+    Recording never takes a lock: each metric is only updated from one
+    thread (the audio thread or the event loop; executor jobs report back
+    to the loop rather than recording themselves), and a scrape that races an update
+    at worst reads a value one observation old.
+    """
+
+    def __init__(self):
+        self.families = {}
+        self._lock = threading.Lock()
+
+    def _register(self, name, help_text, factory, labels):
+        with self._lock:
+            family = self.families.get(name)
+            if family is None:
+                family = MetricFamily(name, help_text, factory, labels)
+                self.families[name] = family
+            return family
+
+    def counter(self, name, help_text, labels=(), fn=None):
+        family = self._register(name, help_text, Counter, labels)
+        if fn is not None:
+            family.children[()].fn = fn
+        return family
+
+    def gauge(self, name, help_text, labels=(), fn=None):
+        family = self._register(name, help_text, Gauge, labels)
+        if fn is not None:
+            family.children[()].fn = fn
+        return family
+
+    def histogram(self, name, help_text, buckets, labels=()):
+        return self._register(name, help_text, lambda: Histogram(buckets), labels)
+
+    def render(self):
+        lines = []
+        for family in list(self.families.values()):
+            lines.extend(family.render())
+        return "\n".join(lines) + "\n"
+
+
+def resident_memory_bytes():
+    """Current RSS from /proc (falls back to peak RSS elsewhere)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def monitor_event_loop(interval=Config.LOOP_LAG_INTERVAL):
+    """Measure how late the event loop wakes up from a sleep"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        EVENT_LOOP_LAG.observe(lag)
+        EVENT_LOOP_LAG_LAST.set(lag)
+
+
+class MetricsServer:
+    """Serves ``/metrics`` on a local port from a background thread"""
+
+    def __init__(self, registry, host=Config.METRICS_HOST, port=Config.METRICS_PORT):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.httpd = None
+
+    def start(self):
+        registry = self.registry
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, name="metrics-http", daemon=True).start()
+        logging.info(f"Metrics served on http://{self.host}:{self.port}/metrics")
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd = None
+
+
+metrics = MetricsRegistry()
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25)
+MEDIA_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+CALLBACK_SECONDS = metrics.histogram(
+    "voice_callback_seconds", "Audio callback processing time", LATENCY_BUCKETS)
+BLOCKS_TOTAL = metrics.counter(
+    "voice_blocks_total", "Audio blocks processed by the callback")
+GATED_BLOCKS_TOTAL = metrics.counter(
+    "voice_gated_blocks_total", "Blocks skipped by the voice activity gate")
+XRUNS_TOTAL = metrics.counter(
+    "voice_xruns_total", "Input overflows / output underflows reported by PortAudio")
+CONVERSIONS_TOTAL = metrics.counter(
+    "voice_conversions_total", "Completed offline conversions", labels=("character",))
+MEDIA_STAGE_SECONDS = metrics.histogram(
+    "media_stage_seconds", "Time spent in each media pipeline stage", MEDIA_BUCKETS, labels=("stage",))
+MEDIA_JOBS_TOTAL = metrics.counter(
+    "media_jobs_total", "Finished media conversions", labels=("result",))
+SPEECH_CACHE_TOTAL = metrics.counter(
+    "speech_cache_requests_total", "`.say` cache lookups", labels=("result",))
+EVENT_LOOP_LAG = metrics.histogram(
+    "event_loop_lag_seconds", "Event loop wake-up lag", LATENCY_BUCKETS)
+EVENT_LOOP_LAG_LAST = metrics.gauge(
+    "event_loop_lag_last_seconds", "Most recent event loop wake-up lag")
+metrics.gauge("process_resident_memory_bytes", "Resident set size", fn=resident_memory_bytes)
+
+# ================================
+# KERNEL BACKENDS
+# ================================
+
+class NumpyKernels:
+    """Reference implementations of the per-sample recursive kernels (vectorized NumPy)"""
+
+    name = "numpy"
+
+    @staticmethod
+    def peak_release(reduction, log_release, state):
+        """``y[n] = max(x[n], exp(log_release) * y[n-1])`` starting from ``state``"""
+        # Solved in closed form in the log domain
+        steps = np.arange(1, len(reduction) + 1) * log_release
+        logs = np.log(np.maximum(reduction, 1e-12)) - steps
+        np.maximum.accumulate(logs, out=logs)
+        np.maximum(logs, np.log(max(state, 1e-12)), out=logs)
+        logs += steps
+        return np.exp(logs)
+
+    @staticmethod
+    def sliding_max(values, width):
+        """Maximum over every window of ``width`` consecutive values"""
+        return sliding_window_view(values, width).max(axis=1)
+
+    @staticmethod
+    def lfo_gain(count, phase, step, depth):
+        """``1 + depth * sin(phase + step * n)`` for n in range(count)"""
+        gain = np.sin(phase + step * np.arange(count))
+        gain *= depth
+        gain += 1.0
+        return gain
+
+    @staticmethod
+    def best_offset(region, template):
+        """Offset into ``region`` where ``template`` correlates best"""
+        return int(np.argmax(sliding_window_view(region, len(template)) @ template))
+
+
+if numba is not None:
+    # cache=True writes the machine code next to this file, so restarts skip compilation
+
+    @numba.njit(cache=True)
+    def _jit_peak_release(reduction, log_release, state):
+        decay = np.exp(log_release)
+        output = np.empty(len(reduction))
+        envelope = max(state, 1e-12)
+        for n in range(len(reduction)):
+            envelope = max(max(reduction[n], 1e-12), envelope * decay)
+            output[n] = envelope
+        return output
+
+    @numba.njit(cache=True)
+    def _jit_sliding_max(values, width):
+        output = np.empty(len(values) - width + 1)
+        for i in range(len(output)):
+            peak = values[i]
+            for j in range(1, width):
+                if values[i + j] > peak:
+                    peak = values[i + j]
+            output[i] = peak
+        return output
+
+    @numba.njit(cache=True)
+    def _jit_lfo_gain(count, phase, step, depth):
+        gain = np.empty(count)
+        for n in range(count):
+            gain[n] = 1.0 + depth * np.sin(phase + step * n)
+        return gain
+
+    @numba.njit(cache=True)
+    def _jit_best_offset(region, template):
+        size = len(template)
+        best = -np.inf
+        offset = 0
+        for i in range(len(region) - size + 1):
+            score = 0.0
+            for j in range(size):
+                score += region[i + j] * template[j]
+            if score > best:
+                best = score
+                offset = i
+        return offset
+
+
+class NumbaKernels:
+    """JIT-compiled loops (numba); same results as NumpyKernels to rounding"""
+
+    name = "numba"
+
+    @staticmethod
+    def peak_release(reduction, log_release, state):
+        return _jit_peak_release(np.ascontiguousarray(reduction, dtype=np.float64),
+                                 float(log_release), float(state))
+
+    @staticmethod
+    def sliding_max(values, width):
+        return _jit_sliding_max(np.ascontiguousarray(values, dtype=np.float64), int(width))
+
+    @staticmethod
+    def lfo_gain(count, phase, step, depth):
+        return _jit_lfo_gain(int(count), float(phase), float(step), float(depth))
+
+    @staticmethod
+    def best_offset(region, template):
+        return int(_jit_best_offset(np.ascontiguousarray(region, dtype=np.float64),
+                                    np.ascontiguousarray(template, dtype=np.float64)))
+
+
+KERNEL_BACKENDS = {"numpy": NumpyKernels}
+if numba is not None:
+    KERNEL_BACKENDS["numba"] = NumbaKernels
+
+
+def warm_kernels(backend):
+    """Run every kernel once so JIT compilation (or cache loading) happens up front"""
+    values = np.linspace(0.0, 1.0, 64)
+    backend.peak_release(values, -0.01, 0.0)
+    backend.sliding_max(values, 4)
+    backend.lfo_gain(64, 0.0, 0.01, 0.5)
+    backend.best_offset(values, values[:16])
+
+
+def set_kernel_backend(name=Config.KERNEL_BACKEND):
+    """Select the kernels every stage uses: "numpy", "numba" or "auto" (numba when installed)"""
+    global kernels
+    if name == "auto":
+        name = "numba" if "numba" in KERNEL_BACKENDS else "numpy"
+    if name not in KERNEL_BACKENDS:
+        raise ValueError(f"Kernel backend '{name}' is not available")
+    backend = KERNEL_BACKENDS[name]
+    try:
+        warm_kernels(backend)
+    except Exception as e:
+        logging.error(f"Kernel backend {name} failed, using numpy: {e}")
+        backend = NumpyKernels
+    kernels = backend
+    return backend
+
+
+kernels = NumpyKernels
+set_kernel_backend()
+
+
+def benchmark_kernels(repeat=200, blocksize=Config.BUFFER_SIZE, seed=0):
+    """Time every kernel on every backend; returns {backend: {kernel: (us per call, max error)}}"""
+    rng = np.random.default_rng(seed)
+    core = WSOLA()
+    cases = {
+        "peak_release": (np.abs(rng.normal(0, 3, blocksize)), -1 / 3528, 2.0),
+        "sliding_max": (np.abs(rng.normal(0, 3, blocksize + 88)), 89),
+        "lfo_gain": (blocksize, 0.3, 2 * np.pi * 5 / Config.SAMPLE_RATE, 0.3),
+        "best_offset": (rng.normal(0, 0.1, core.frame_size + 2 * core.tolerance),
+                        rng.normal(0, 0.1, core.frame_size)),
+    }
+    
+    results = {}
+    reference = {kernel: getattr(NumpyKernels, kernel)(*args) for kernel, args in cases.items()}
+    for name, backend in KERNEL_BACKENDS.items():
+        warm_kernels(backend)
+        results[name] = {}
+        for kernel, args in cases.items():
+            function = getattr(backend, kernel)
+            started = time.perf_counter()
+            for _ in range(repeat):
+                output = function(*args)
+            elapsed = (time.perf_counter() - started) / repeat
+            error = float(np.max(np.abs(np.asarray(output, dtype=float) - reference[kernel])))
+            results[name][kernel] = (elapsed * 1e6, error)
+    return results
+
+# ================================
+# SPECTRAL ENVELOPE WARPING
+# ================================
+
+class FormantWarper:
+    """Streaming formant shifter using LPC or cepstral envelope warping
+
+    Audio is cut into fixed-size overlapping frames, the spectral envelope of
+    each frame is estimated and resampled along the frequency axis by
+    ``factor`` while the fine (pitch) structure is kept. All frames of a block
+    are processed as one vectorized batch. Latency is one frame.
+    """
+
+    METHODS = ("cepstral", "lpc")
+
+    # Cap envelope correction so near-silent bins are not blown up
+    MAX_CORRECTION_DB = 24.0
+
+    def __init__(self, factor, method="cepstral", sample_rate=Config.SAMPLE_RATE,
+                 frame_size=Config.FORMANT_FRAME_SIZE, hop_size=Config.FORMANT_HOP_SIZE):
+        if method not in self.METHODS:
+            raise ValueError(f"Unknown formant method: {method}")
+        if frame_size % hop_size:
+            raise ValueError("frame_size must be a multiple of hop_size")
+
+        self.factor = float(factor)
+        self.method = method
+        self.sample_rate = sample_rate
+        self.frame_size = frame_size
+        self.hop_size = hop_size
+        self.bins = frame_size // 2 + 1
+
+        # Precomputed analysis/synthesis windows (sqrt periodic Hann, WOLA)
+        window = np.sqrt(np.hanning(frame_size + 1)[:frame_size])
+        overlap = frame_size // hop_size
+        norm = (window * window).reshape(overlap, hop_size).sum(axis=0)[0]
+        self.analysis_window = window
+        self.synthesis_window = window / norm
+
+        # Cepstral lifter keeps quefrencies below ~1 ms (above any voice F0)
+        lifter_len = max(8, int(sample_rate / 1000))
+        lifter = np.zeros(frame_size)
+        lifter[:lifter_len] = 1.0
+        lifter[1:lifter_len] = 2.0
+        self.lifter = lifter
+
+        # LPC order rule of thumb: 2 + fs / 1 kHz
+        self.lpc_order = 2 + int(sample_rate / 1000)
+
+        self.warp_matrix = self._build_warp_matrix(self.factor, self.bins)
+        self.max_correction = self.MAX_CORRECTION_DB / 20 * np.log(10)
+
+        # Cost accounting
+        self.frames_processed = 0
+        self.total_time = 0.0
+
+        self.reset()
+
+    @staticmethod
+    def _build_warp_matrix(factor, bins):
+        """Linear-interpolation matrix mapping envelope bin k to bin k / factor"""
+        source = np.clip(np.arange(bins) / factor, 0, bins - 1)
+        lower = np.floor(source).astype(int)
+        upper = np.minimum(lower + 1, bins - 1)
+        frac = source - lower
+
+        matrix = np.zeros((bins, bins))
+        rows = np.arange(bins)
+        matrix[rows, lower] += 1.0 - frac
+        matrix[rows, upper] += frac
+        return matrix
+
+    @classmethod
+    def design(cls, params, sample_rate):
+        # The warp matrix is rebuilt from ``factor`` (~0.1 ms); loading it is slower
+        return {}
+
+    @classmethod
+    def from_params(cls, params, coeffs, sample_rate):
+        return cls(params["factor"], method=params["method"], sample_rate=sample_rate)
+
+    @property
+    def latency(self):
+        """Processing delay in samples"""
+        return self.frame_size
+
+    @property
+    def cost_per_frame_us(self):
+        """Average processing cost per analysis frame in microseconds"""
+        if not self.frames_processed:
+            return 0.0
+        return self.total_time / self.frames_processed * 1e6
+
+    def reset(self, channels=()):
+        """Clear streaming buffers (``channels`` is the trailing block shape)"""
+        self._channels = tuple(channels)
+        self._input_tail = np.zeros((self.frame_size - self.hop_size,) + self._channels)
+        self._overlap = np.zeros((self.frame_size - self.hop_size,) + self._channels)
+        self._output_fifo = np.zeros((self.hop_size,) + self._channels)
+
+    def log_envelope(self, spectra):
+        """Natural-log magnitude envelope for a batch of rfft frames"""
+        if self.method == "lpc":
+            return self._lpc_envelope(spectra)
+        return self._cepstral_envelope(spectra)
+
+    def _cepstral_envelope(self, spectra):
+        log_mag = np.log(np.abs(spectra) + 1e-9)
+        cepstrum = np.fft.irfft(log_mag, n=self.frame_size, axis=-1)
+        return np.fft.rfft(cepstrum * self.lifter, axis=-1).real
+
+    def _lpc_envelope(self, spectra):
+        # Autocorrelation from the power spectrum, then batched Levinson-Durbin
+        power = (spectra * spectra.conj()).real
+        autocorr = np.fft.irfft(power, n=self.frame_size, axis=-1)[..., :self.lpc_order + 1]
+        autocorr[..., 0] = autocorr[..., 0] * (1 + 1e-9) + 1e-12
+
+        coeffs = np.zeros(autocorr.shape)
+        coeffs[..., 0] = 1.0
+        error = autocorr[..., 0].copy()
+        for i in range(1, self.lpc_order + 1):
+            acc = np.einsum("...j,...j->...", coeffs[..., :i], autocorr[..., i:0:-1])
+            k = -acc / error
+            coeffs[..., 1:i + 1] += k[..., None] * coeffs[..., i - 1::-1]
+            error *= 1.0 - k * k
+
+        response = np.fft.rfft(coeffs, n=self.frame_size, axis=-1)
+        return -np.log(np.abs(response) + 1e-9)
+
+    def process_frames(self, frames):
+        """Warp the envelope of a (..., frame_size) batch of raw frames"""
+        spectra = np.fft.rfft(frames * self.analysis_window, axis=-1)
+        envelope = self.log_envelope(spectra)
+        warped = envelope @ self.warp_matrix.T
+        correction = np.clip(warped - envelope, -self.max_correction, self.max_correction)
+        spectra *= np.exp(correction)
+        return np.fft.irfft(spectra, n=self.frame_size, axis=-1) * self.synthesis_window
+
+    def decay(self, factor):
+        """Scale buffered audio towards silence (used while gated)"""
+        self._input_tail *= factor
+        self._overlap *= factor
+        self._output_fifo *= factor
+
+    def process(self, audio_data):
+        """Process one block, returning the same number of samples"""
+        if self.factor == 1.0:
+            return audio_data
+
+        start = time.perf_counter()
+        if audio_data.shape[1:] != self._channels:
+            self.reset(audio_data.shape[1:])
+        
+        hop = self.hop_size
+        buffer = np.concatenate((self._input_tail, audio_data))
+        n_frames = (len(buffer) - self.frame_size) // hop + 1
+        consumed = n_frames * hop
+
+        if n_frames > 0:
+            # (n_frames, [channels,] frame_size) views, all channels in one batch
+            frames = sliding_window_view(buffer, self.frame_size, axis=0)[::hop][:n_frames]
+            synthesized = np.moveaxis(self.process_frames(frames), -1, 1)
+
+            # Vectorized overlap-add: each hop-sized column of a frame lands
+            # one hop further along the output
+            overlap_add = np.concatenate((self._overlap, np.zeros((consumed,) + self._channels)))
+            for offset in range(self.frame_size // hop):
+                segment = synthesized[:, offset * hop:(offset + 1) * hop].reshape((-1,) + self._channels)
+                overlap_add[offset * hop:offset * hop + consumed] += segment
+
+            self._output_fifo = np.concatenate((self._output_fifo, overlap_add[:consumed]))
+            self._overlap = overlap_add[consumed:]
+            self.frames_processed += n_frames * max(1, int(np.prod(self._channels)))
+
+        self._input_tail = buffer[consumed:]
+        output = self._output_fifo[:len(audio_data)]
+        self._output_fifo = self._output_fifo[len(audio_data):]
+        self.total_time += time.perf_counter() - start
+        return output
+
+# ================================
+# DYNAMICS PROCESSING
+# ================================
+
+class DynamicsProcessor:
+    """Streaming feed-forward compressor/limiter with lookahead
+
+    The gain computer is a vectorized soft-knee curve on the sample peak
+    level. Gain reduction is held over the lookahead window, released
+    exponentially (in dB) and ramped in over the attack time, with all
+    envelope state carried between blocks. Audio is delayed by the lookahead
+    so the gain is already down when a peak arrives.
+    """
+
+    def __init__(self, threshold_db=-12.0, ratio=4.0, knee_db=6.0, attack_ms=2.0,
+                 release_ms=80.0, lookahead_ms=2.0, makeup_db=0.0,
+                 sample_rate=Config.SAMPLE_RATE):
+        self.threshold_db = float(threshold_db)
+        self.ratio = float(ratio)
+        self.knee_db = float(knee_db)
+        self.makeup_db = float(makeup_db)
+        self.sample_rate = sample_rate
+
+        self.slope = 1.0 - 1.0 / self.ratio
+        self.lookahead = max(1, int(round(lookahead_ms * sample_rate / 1000)))
+        self.attack = max(1, int(round(attack_ms * sample_rate / 1000)))
+        # log of the per-sample decay factor of the release envelope
+        self.log_release = -1.0 / max(release_ms * sample_rate / 1000, 1.0)
+
+        self.reset()
+
+    @classmethod
+    def limiter(cls, ceiling_db=-0.5, lookahead_ms=1.5, release_ms=60.0,
+                sample_rate=Config.SAMPLE_RATE):
+        """Brickwall limiter: attack spans the lookahead so peaks never pass the ceiling"""
+        return cls(threshold_db=ceiling_db, ratio=np.inf, knee_db=0.0,
+                   attack_ms=lookahead_ms, release_ms=release_ms,
+                   lookahead_ms=lookahead_ms, sample_rate=sample_rate)
+
+    @classmethod
+    def design(cls, params, sample_rate):
+        return {}
+
+    @classmethod
+    def from_params(cls, params, coeffs, sample_rate):
+        return cls(sample_rate=sample_rate, **params)
+
+    @property
+    def latency(self):
+        """Processing delay in samples"""
+        return self.lookahead
+
+    def reset(self, channels=()):
+        """Clear delay line and envelope state (``channels`` is the trailing block shape)"""
+        self._channels = tuple(channels)
+        self._delay = np.zeros((self.lookahead,) + self._channels)
+        self._reduction_history = np.zeros(self.lookahead)
+        self._attack_history = np.zeros(self.attack - 1)
+        self._release_state = 0.0
+        self.gain_reduction_db = 0.0
+
+    def decay(self, factor):
+        """Scale the delay line towards silence (used while gated)"""
+        self._delay *= factor
+
+    def gain_computer(self, audio_data):
+        """Required gain reduction in dB for each sample (soft knee, channels linked)"""
+        peak = np.abs(audio_data)
+        if peak.ndim > 1:
+            peak = peak.reshape(len(peak), -1).max(axis=1)
+        level = 20 * np.log10(peak + 1e-9)
+        over = level - self.threshold_db
+        if self.knee_db > 0:
+            knee = np.clip(over + self.knee_db / 2, 0, self.knee_db)
+            over = knee * knee / (2 * self.knee_db) + np.maximum(over - self.knee_db / 2, 0)
+        else:
+            over = np.maximum(over, 0)
+        return over * self.slope
+
+    def _release(self, reduction):
+        envelope = kernels.peak_release(reduction, self.log_release, self._release_state)
+        self._release_state = envelope[-1]
+        return envelope
+
+    def process(self, audio_data):
+        """Process one block, returning the same number of samples"""
+        n = len(audio_data)
+        if n == 0:
+            return audio_data
+        if audio_data.shape[1:] != self._channels:
+            self.reset(audio_data.shape[1:])
+
+        # Hold the largest reduction needed anywhere in the lookahead window
+        reduction = np.concatenate((self._reduction_history, self.gain_computer(audio_data)))
+        held = kernels.sliding_max(reduction, self.lookahead + 1)
+        self._reduction_history = reduction[-self.lookahead:]
+
+        envelope = self._release(held)
+
+        # Attack: moving average ramps the reduction in ahead of the peak
+        if self.attack > 1:
+            ramp = np.concatenate((self._attack_history, envelope))
+            sums = np.cumsum(ramp)
+            smoothed = sums[self.attack - 1:].copy()
+            smoothed[1:] -= sums[:-self.attack]
+            smoothed /= self.attack
+            self._attack_history = ramp[-(self.attack - 1):]
+            envelope = smoothed
+
+        self.gain_reduction_db = float(envelope[-1])
+
+        # Delay the audio by the lookahead and apply the gain in place
+        delayed = np.concatenate((self._delay, audio_data))
+        self._delay = delayed[n:].copy()
+        output = delayed[:n]
+        envelope -= self.makeup_db
+        envelope *= -np.log(10) / 20
+        np.exp(envelope, out=envelope)
+        output *= envelope.reshape((n,) + (1,) * len(self._channels))
+        return output
+
+# ================================
+# LOUDNESS NORMALIZATION
+# ================================
+
+def k_weighting(sample_rate=Config.SAMPLE_RATE):
+    """ITU-R BS.1770 K-weighting (high shelf + high-pass) as second-order sections
+
+    The analog prototypes are re-derived for ``sample_rate``; at 48 kHz they
+    reproduce the coefficients printed in the standard.
+    """
+    sos = np.zeros((2, 6))
+    
+    # Stage 1: +4 dB high shelf modelling the head
+    gain, q, fc = 3.99984385397, 0.7071752369554193, 1681.9744509555319
+    K = np.tan(np.pi * fc / sample_rate)
+    Vh = 10 ** (gain / 20)
+    Vb = Vh ** 0.4996667741545416
+    a0 = 1 + K / q + K * K
+    sos[0] = [(Vh + Vb * K / q + K * K) / a0, 2 * (K * K - Vh) / a0, (Vh - Vb * K / q + K * K) / a0,
+              1, 2 * (K * K - 1) / a0, (1 - K / q + K * K) / a0]
+    
+    # Stage 2: RLB high-pass
+    q, fc = 0.5003270373253953, 38.13547087613982
+    K = np.tan(np.pi * fc / sample_rate)
+    a0 = 1 + K / q + K * K
+    sos[1] = [1, -2, 1, 1, 2 * (K * K - 1) / a0, (1 - K / q + K * K) / a0]
+    return sos
+
+
+class LoudnessMeter:
+    """Streaming BS.1770 loudness: momentary (400 ms), short-term (3 s) and gated short-term
+
+    K-weighted energy is accumulated into 100 ms buckets aligned to the
+    stream position. Each window keeps a running sum over a ring of
+    buckets, so a block costs one ``sosfilt`` call plus O(1) work per
+    completed bucket (sums are recomputed exactly once per ring turn to
+    stop rounding drift). The gated short-term value only counts buckets
+    above ``LOUDNESS_GATE_LUFS``, so pauses do not drag it down.
+    """
+
+    BUCKET_SECONDS = 0.1
+    MOMENTARY_BUCKETS = 4
+    SHORT_TERM_BUCKETS = 30
+
+    def __init__(self, sample_rate=Config.SAMPLE_RATE):
+        self.sos = k_weighting(sample_rate)
+        self.bucket = int(round(sample_rate * self.BUCKET_SECONDS))
+        self.gate_energy = 10 ** ((Config.LOUDNESS_GATE_LUFS + 0.691) / 10) * self.bucket
+        self._position = 0
+        self.reset()
+
+    def reset(self, channels=()):
+        """Clear measurements; bucket boundaries stay aligned to the stream position"""
+        self._channels = tuple(channels)
+        self.zi = np.zeros((len(self.sos), 2) + self._channels)
+        self._ring = np.zeros(self.SHORT_TERM_BUCKETS)
+        self._head = 0
+        self._filled = 0
+        self._partial = 0.0
+        self._partial_count = self._position % self.bucket
+        self._momentary_sum = 0.0
+        self._short_sum = 0.0
+        self._gated_sum = 0.0
+        self._gated_count = 0
+
+    def seek(self, position):
+        self._position = position
+        self.reset(self._channels)
+
+    @staticmethod
+    def _lufs(energy, samples):
+        if samples <= 0 or energy <= 0:
+            return -np.inf
+        return -0.691 + 10 * np.log10(energy / samples)
+
+    @property
+    def momentary(self):
+        count = min(self._filled, self.MOMENTARY_BUCKETS)
+        return self._lufs(self._momentary_sum, count * self.bucket)
+
+    @property
+    def short_term(self):
+        count = min(self._filled, self.SHORT_TERM_BUCKETS)
+        return self._lufs(self._short_sum, count * self.bucket)
+
+    @property
+    def gated_short_term(self):
+        return self._lufs(self._gated_sum, self._gated_count * self.bucket)
+
+    def _push(self, energy):
+        ring = self._ring
+        oldest = ring[self._head]
+        self._short_sum += energy - oldest
+        self._momentary_sum += energy - ring[(self._head - self.MOMENTARY_BUCKETS) % len(ring)]
+        if oldest > self.gate_energy:
+            self._gated_sum -= oldest
+            self._gated_count -= 1
+        if energy > self.gate_energy:
+            self._gated_sum += energy
+            self._gated_count += 1
+        
+        ring[self._head] = energy
+        self._head = (self._head + 1) % len(ring)
+        self._filled += 1
+        if self._head == 0:
+            self._short_sum = ring.sum()
+            self._momentary_sum = ring[-self.MOMENTARY_BUCKETS:].sum()
+            active = ring[ring > self.gate_energy]
+            self._gated_sum, self._gated_count = active.sum(), len(active)
+
+    def _accumulate(self, energy):
+        position = 0
+        while position < len(energy):
+            take = min(self.bucket - self._partial_count, len(energy) - position)
+            self._partial += float(energy[position:position + take].sum())
+            self._partial_count += take
+            position += take
+            if self._partial_count == self.bucket:
+                self._push(self._partial)
+                self._partial = 0.0
+                self._partial_count = 0
+
+    def process(self, audio_data):
+        """Measure one block (the audio is not modified)"""
+        if audio_data.shape[1:] != self._channels:
+            self.reset(audio_data.shape[1:])
+        filtered, self.zi = sosfilt(self.sos, audio_data, axis=0, zi=self.zi)
+        energy = np.square(filtered)
+        if energy.ndim > 1:
+            energy = energy.reshape(len(energy), -1).sum(axis=1)
+        self._accumulate(energy)
+        self._position += len(audio_data)
+
+    def advance(self, frames):
+        """Count ``frames`` of silence (blocks the chain skipped)"""
+        self.zi *= 0.0
+        self._accumulate(np.zeros(frames))
+        self._position += frames
+
+
+class LoudnessNormalizer:
+    """Makeup gain that brings the gated short-term loudness to a target
+
+    Loudness is measured before the gain is applied, so there is no feedback
+    loop, and the gain depends only on the last three seconds of input
+    (parallel renders converge after the pre-roll). The gain moves with a
+    per-sample ramp between blocks and is limited to ``LOUDNESS_MAX_BOOST_DB``
+    / ``LOUDNESS_MAX_CUT_DB``; the output limiter after it catches peaks.
+    """
+
+    def __init__(self, sample_rate=Config.SAMPLE_RATE):
+        self.meter = LoudnessMeter(sample_rate)
+        self.gain_db = 0.0
+
+    def reset(self):
+        self.meter.reset()
+        self.gain_db = 0.0
+
+    def seek(self, position):
+        self.meter.seek(position)
+        self.gain_db = 0.0
+
+    def advance(self, frames):
+        self.meter.advance(frames)
+
+    def process(self, audio_data, target_lufs=Config.TARGET_LUFS):
+        self.meter.process(audio_data)
+        loudness = self.meter.gated_short_term
+        gain_db = 0.0
+        if np.isfinite(loudness):
+            gain_db = float(np.clip(target_lufs - loudness,
+                                    -Config.LOUDNESS_MAX_CUT_DB, Config.LOUDNESS_MAX_BOOST_DB))
+        
+        n = len(audio_data)
+        ramp = np.linspace(self.gain_db, gain_db, n + 1)[1:]
+        ramp *= np.log(10) / 20
+        np.exp(ramp, out=ramp)
+        self.gain_db = gain_db
+        return audio_data * ramp.reshape((n,) + (1,) * (audio_data.ndim - 1))
+
+# ================================
+# SAMPLE LIBRARY & CONVOLUTION
+# ================================
+
+class SampleLibrary:
+    """Impulse responses and effect samples stored as raw float32 files
+
+    Files are opened with ``np.memmap``, so only the pages that are actually
+    touched are read. Convolution partition spectra are computed once per
+    (sample, partition) and shared read-only by every convolver, so
+    characters using the same impulse response share memory. Missing
+    built-in impulse responses are synthesized once and written to disk.
+    """
+
+    SUFFIX = ".f32"
+
+    def __init__(self, directory=Config.SAMPLES_DIR, sample_rate=Config.SAMPLE_RATE):
+        self.directory = Path(directory)
+        self.sample_rate = sample_rate
+        self._maps = {}
+        self._spectra = {}
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        return self.directory / f"{name}{self.SUFFIX}"
+
+    def get(self, name):
+        """Memory-mapped read-only view of a sample"""
+        with self._lock:
+            samples = self._maps.get(name)
+            if samples is None:
+                path = self.path(name)
+                if not path.exists():
+                    if name not in self.BUILTIN_IMPULSES:
+                        raise FileNotFoundError(f"Sample not found: {path}")
+                    self._write(name, self.BUILTIN_IMPULSES[name](self.sample_rate))
+                samples = np.memmap(path, dtype=np.float32, mode="r")
+                self._maps[name] = samples
+            return samples
+
+    def spectra(self, name, partition):
+        """Shared, read-only UPOLS partition spectra of a sample"""
+        key = (name, int(partition))
+        spectra = self._spectra.get(key)
+        if spectra is None:
+            spectra = PartitionedConvolver.partition_spectra(self.get(name), partition)
+            spectra.flags.writeable = False
+            with self._lock:
+                spectra = self._spectra.setdefault(key, spectra)
+        return spectra
+
+    def _write(self, name, samples):
+        # Caller may hold the lock (get() synthesizing a built-in)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path(name).with_suffix(".tmp")
+        np.asarray(samples, dtype=np.float32).tofile(tmp_path)
+        os.replace(tmp_path, self.path(name))
+
+    def store(self, name, samples):
+        """Write a sample as raw float32"""
+        self._write(name, samples)
+        with self._lock:
+            self._maps.pop(name, None)
+            self._spectra = {key: value for key, value in self._spectra.items() if key[0] != name}
+
+    # Built-in impulse responses ------------------------------------------
+
+    @staticmethod
+    def _room_impulse(sample_rate):
+        # Direct sound plus exponentially decaying diffuse tail (RT60 ~ 0.5 s)
+        rng = np.random.default_rng(1)
+        length = int(0.6 * sample_rate)
+        t = np.arange(length) / sample_rate
+        tail = rng.standard_normal(length) * np.exp(-6.9 * t / 0.5)
+        tail[:int(0.005 * sample_rate)] = 0.0
+        tail *= 0.5 / np.sqrt(np.sum(tail ** 2))
+        tail[0] = 1.0
+        return tail
+
+    @staticmethod
+    def _phone_impulse(sample_rate):
+        # Narrowband telephone channel (300-3400 Hz)
+        return firwin(255, [300, 3400], pass_zero=False, fs=sample_rate)
+
+    @staticmethod
+    def _radio_impulse(sample_rate):
+        # AM broadcast band with a slight speaker-cone resonance
+        impulse = firwin(255, [400, 4500], pass_zero=False, fs=sample_rate)
+        t = np.arange(len(impulse)) / sample_rate
+        impulse += 0.3 * impulse.max() * np.sin(2 * np.pi * 1800 * t) * np.exp(-t / 0.002)
+        return impulse
+
+    @staticmethod
+    def _megaphone_impulse(sample_rate):
+        # Horn band-limit plus short, strong internal reflections
+        impulse = firwin(255, [600, 3500], pass_zero=False, fs=sample_rate)
+        horn = np.zeros(len(impulse) + int(0.004 * sample_rate))
+        for delay_ms, gain in ((0.0, 1.0), (1.1, 0.6), (2.3, 0.35), (3.6, 0.2)):
+            offset = int(delay_ms * sample_rate / 1000)
+            horn[offset:offset + len(impulse)] += gain * impulse
+        return horn * 1.5
+
+    BUILTIN_IMPULSES = {
+        "room": _room_impulse.__func__,
+        "phone": _phone_impulse.__func__,
+        "radio": _radio_impulse.__func__,
+        "megaphone": _megaphone_impulse.__func__,
+    }
+
+
+class PartitionedConvolver:
+    """Uniform-partitioned overlap-save (UPOLS) FFT convolution stage
+
+    The impulse response is split into block-sized partitions whose spectra
+    are precomputed; each block costs one FFT/IFFT pair plus a multiply-add
+    over the frequency-domain delay line. Latency stays at one block however
+    long the impulse response is.
+    """
+
+    latency = 0
+
+    def __init__(self, impulse, partition=Config.BUFFER_SIZE, wet=1.0, dry=0.0, name=None):
+        self.impulse = impulse
+        # Named samples take their spectra from the shared library cache
+        self.name = name
+        self.wet = float(wet)
+        self.dry = float(dry)
+        self.set_partition(partition)
+
+    @property
+    def tail(self):
+        """Impulse response length in samples"""
+        return len(self.impulse)
+
+    @classmethod
+    def design(cls, params, sample_rate):
+        return {}
+
+    @classmethod
+    def from_params(cls, params, coeffs, sample_rate):
+        name = params["impulse_response"]
+        return cls(sample_library.get(name),
+                   partition=params.get("partition", Config.BUFFER_SIZE),
+                   wet=params.get("wet", 1.0), dry=params.get("dry", 0.0), name=name)
+
+    @staticmethod
+    def partition_spectra(impulse, partition):
+        """Spectra of the zero-padded block-sized partitions of an impulse response"""
+        count = max(1, -(-len(impulse) // partition))
+        parts = np.zeros((count, 2 * partition))
+        parts[:, :partition].flat[:len(impulse)] = impulse
+        return np.fft.rfft(parts, axis=-1)
+
+    def set_partition(self, partition):
+        """Re-split the impulse response for a new block size (clears state)"""
+        self.partition = int(partition)
+        if self.name is not None:
+            self.spectra = sample_library.spectra(self.name, self.partition)
+        else:
+            self.spectra = self.partition_spectra(self.impulse, self.partition)
+        self.reset(getattr(self, "_channels", ()))
+
+    def reset(self, channels=()):
+        self._channels = tuple(channels)
+        self._window = np.zeros((2 * self.partition,) + self._channels)
+        self._delay_line = np.zeros(self.spectra.shape + self._channels, dtype=complex)
+        self._head = 0
+
+    def decay(self, factor):
+        """Scale the input history towards silence (used while gated)"""
+        self._window *= factor
+        self._delay_line *= factor
+
+    def _process_partition(self, block):
+        P = self.partition
+        self._window[:P] = self._window[P:]
+        self._window[P:] = block
+
+        # Newest input spectrum goes in front of the ring; age k pairs with partition k
+        count = len(self.spectra)
+        self._head = (self._head - 1) % count
+        self._delay_line[self._head] = np.fft.rfft(self._window, axis=0)
+        split = count - self._head
+        accumulated = np.einsum("kb...,kb->b...", self._delay_line[self._head:], self.spectra[:split])
+        if self._head:
+            accumulated += np.einsum("kb...,kb->b...", self._delay_line[:self._head], self.spectra[split:])
+
+        wet = np.fft.irfft(accumulated, n=2 * P, axis=0)[P:]
+        if self.dry:
+            wet *= self.wet
+            wet += self.dry * block
+        elif self.wet != 1.0:
+            wet *= self.wet
+        return wet
+
+    def process(self, audio_data):
+        """Convolve one block (multiples of the partition are split up)"""
+        n = len(audio_data)
+        if audio_data.shape[1:] != self._channels:
+            self.reset(audio_data.shape[1:])
+        if n == self.partition:
+            return self._process_partition(audio_data)
+        if n and n % self.partition == 0:
+            return np.concatenate([self._process_partition(audio_data[i:i + self.partition])
+                                   for i in range(0, n, self.partition)])
+        
+        logging.info(f"Convolution partition changed: {self.partition} -> {n}")
+        self.set_partition(n)
+        return self._process_partition(audio_data)
+
+
+sample_library = SampleLibrary(Config.SAMPLES_DIR)
+
+# ================================
+# PROCESSING STAGES
+# ================================
+
+class WSOLA:
+    """Streaming waveform-similarity overlap-add (time-scale modification) core
+
+    The caller chooses the nominal analysis position of every frame; the
+    core searches ``tolerance`` samples around it for the segment that best
+    continues the previously chosen one (one matrix-vector product over all
+    candidate offsets), windows it and overlap-adds at a fixed synthesis hop
+    of half a frame. Positions are absolute stream indices, so the grid can
+    be re-established after a seek. Channels share one offset (searched on
+    their mean) to keep the stereo image intact.
+    """
+
+    def __init__(self, frame_size=Config.WSOLA_FRAME_SIZE, tolerance=Config.WSOLA_TOLERANCE):
+        self.frame_size = frame_size
+        self.hop = frame_size // 2
+        self.tolerance = tolerance
+        # Periodic Hann: overlapping copies at half a frame sum to exactly one
+        self.window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(frame_size) / frame_size)
+        self.reset()
+
+    def reset(self, channels=(), position=0):
+        """Start a stream whose next pushed sample has absolute index ``position``"""
+        self._channels = tuple(channels)
+        self._input = np.zeros((0,) + self._channels)
+        self._base = position
+        self._previous = None
+        self._overlap = np.zeros((self.hop,) + self._channels)
+
+    @property
+    def end(self):
+        """Absolute index one past the last pushed sample"""
+        return self._base + len(self._input)
+
+    def push(self, audio_data):
+        self._input = np.concatenate([self._input, audio_data])
+
+    def decay(self, factor):
+        self._input *= factor
+        self._overlap *= factor
+
+    def ready(self, position, template=None):
+        """Whether enough input is buffered to synthesise the frame at ``position``"""
+        needed = position + self.tolerance
+        if template is not None and template < self._base:
+            template = None
+        if template is None and self._previous is not None:
+            template = self._previous + self.hop
+        if template is not None:
+            needed = max(needed, template)
+        return needed + self.frame_size <= self.end
+
+    def level_db(self, position):
+        """RMS level of the nominal frame at ``position``"""
+        start = max(position - self._base, 0)
+        segment = self._input[start:start + self.frame_size]
+        return 10 * np.log10(np.mean(np.square(segment)) + 1e-12)
+
+    def _mono(self, start, stop):
+        segment = self._input[start - self._base:stop - self._base]
+        return segment.mean(axis=1) if segment.ndim > 1 else segment
+
+    def frame(self, position, template=None):
+        """Synthesise the next frame; returns ``hop`` finished output samples
+
+        The search matches the natural continuation of the previous chosen
+        frame unless ``template`` gives another absolute start to match.
+        """
+        N = self.frame_size
+        low = max(position - self.tolerance, self._base)
+        high = max(position + self.tolerance, low)
+        if template is not None and template < self._base:
+            # Anchor from before the stream started
+            template = None
+        if template is None and self._previous is not None:
+            template = self._previous + self.hop
+        
+        if template is None:
+            start = max(position, self._base)
+        else:
+            start = low + kernels.best_offset(self._mono(low, high + N), self._mono(template, template + N))
+        
+        offset = start - self._base
+        segment = self._input[offset:offset + N]
+        frame = segment * self.window.reshape((N,) + (1,) * (segment.ndim - 1))
+        
+        output = self._overlap + frame[:self.hop]
+        self._overlap = frame[self.hop:].copy()
+        self._previous = start
+        
+        # Keep only what the next search or template can still reach
+        keep = min(low, start + self.hop, template if template is not None else start) - self._base
+        if keep > 0:
+            self._input = self._input[keep:]
+            self._base += keep
+        return output
+
+
+class PitchShiftStage:
+    """Duration-preserving pitch shifter
+
+    WSOLA stretches the input by ``factor`` and a linear-interpolating reader
+    plays the stretched signal back ``factor`` times faster, so pitch moves
+    while duration stays put. Output sample ``n`` reads stretched sample
+    ``(n - latency) * factor``, which keeps the delay constant and lets a
+    render started mid-stream (``seek``) land on the same grid. Every
+    ``WSOLA_ANCHOR_FRAMES`` frames the search matches the previous frame's
+    nominal rather than chosen continuation, so the chosen path (and with
+    it the output) stops depending on where the stream started.
+    """
+
+    def __init__(self, factor):
+        self.factor = float(factor)
+        self.core = WSOLA()
+        self.latency = 0 if self.factor == 1.0 else self.core.frame_size + self.core.tolerance + self.core.hop + 2
+        self._position = 0
+        self.reset()
+
+    @classmethod
+    def design(cls, params, sample_rate):
+        return {}
+
+    @classmethod
+    def from_params(cls, params, coeffs, sample_rate):
+        return cls(params["factor"])
+
+    def reset(self, channels=()):
+        """Clear state; the stream position is kept"""
+        self._channels = tuple(channels)
+        self._stale = False
+        self.core.reset(self._channels, position=self._position)
+        # First frame whose analysis position lies inside the stream
+        self._frame = int(np.ceil(self._position * self.factor / self.core.hop))
+        self._stretched = np.zeros((0,) + self._channels)
+        self._stretched_base = self._frame * self.core.hop
+
+    def seek(self, position):
+        """Continue as a stream would ``position`` samples in (with silence before)"""
+        self._position = position
+        self.reset(self._channels)
+
+    def advance(self, frames):
+        """Account for blocks the chain skipped; state restarts at the new position"""
+        self._position += frames
+        self._stale = True
+
+    def decay(self, factor):
+        self.core.decay(factor)
+        self._stretched *= factor
+
+    def process(self, audio_data):
+        if self.factor == 1.0:
+            return audio_data
+        if self._stale or audio_data.shape[1:] != self._channels:
+            self.reset(audio_data.shape[1:])
+        
+        count = len(audio_data)
+        self.core.push(audio_data)
+        positions = (self._position + np.arange(count) - self.latency) * self.factor
+        self._position += count
+        
+        # Synthesise until the stretched signal covers this block's read positions
+        hop = self.core.hop
+        needed = int(np.floor(positions[-1])) + 2
+        chunks = [self._stretched]
+        stretched_end = self._stretched_base + len(self._stretched)
+        while stretched_end < needed:
+            analysis = int(round(self._frame * hop / self.factor))
+            template = None
+            if self._frame % Config.WSOLA_ANCHOR_FRAMES == 0:
+                template = int(round((self._frame - 1) * hop / self.factor)) + hop
+            if not self.core.ready(analysis, template):
+                break
+            chunks.append(self.core.frame(analysis, template))
+            self._frame += 1
+            stretched_end += hop
+        stretched = np.concatenate(chunks)
+        
+        # Linear interpolation; positions outside the stretched signal read silence
+        index = np.floor(positions).astype(int) - self._stretched_base
+        fraction = (positions - np.floor(positions)).reshape((count,) + (1,) * len(self._channels))
+        valid = (index >= 0) & (index + 1 < len(stretched))
+        output = np.zeros(audio_data.shape)
+        i = index[valid]
+        output[valid] = stretched[i] * (1 - fraction[valid]) + stretched[i + 1] * fraction[valid]
+        
+        drop = max(0, min(int(np.floor(positions[-1])) - self._stretched_base, len(stretched)))
+        self._stretched = stretched[drop:]
+        self._stretched_base += drop
+        return output
+
+
+class FilterStage:
+    """Causal Butterworth filter with carried state, optionally mixed in parallel
+
+    With ``mix`` set the output is ``dry + mix * filtered`` (the tone-profile
+    boosts); without it the filtered signal replaces the input.
+    """
+
+    latency = 0
+
+    def __init__(self, sos, mix=None):
+        self.sos = sos
+        self.mix = mix
+        self.reset()
+
+    @classmethod
+    def design(cls, params, sample_rate):
+        cutoff = np.atleast_1d(np.asarray(params["cutoff"], dtype=float))
+        nyquist = sample_rate / 2
+        cutoff = np.minimum(cutoff, nyquist - 100) / nyquist
+        sos = butter(params["order"], cutoff if len(cutoff) > 1 else cutoff[0],
+                     btype=params["btype"], output="sos")
+        return {"sos": sos}
+
+    @classmethod
+    def from_params(cls, params, coeffs, sample_rate):
+        return cls(coeffs["sos"], mix=params.get("mix"))
+
+    def reset(self, channels=()):
+        # One (sections, 2) state per channel, filtered in a single call
+        self.zi = np.zeros((self.sos.shape[0], 2) + tuple(channels))
+
+    def decay(self, factor):
+        """Scale the filter state towards zero (used while gated)"""
+        self.zi *= factor
+
+    def process(self, audio_data):
+        if self.zi.shape[2:] != audio_data.shape[1:]:
+            self.reset(audio_data.shape[1:])
+        filtered, self.zi = sosfilt(self.sos, audio_data, axis=0, zi=self.zi)
+        if self.mix is None:
+            return filtered
+        filtered *= self.mix
+        filtered += audio_data
+        return filtered
+
+
+class TremoloStage:
+    """Amplitude LFO with phase carried between blocks"""
+
+    latency = 0
+
+    def __init__(self, rate_hz, depth, sample_rate=Config.SAMPLE_RATE):
+        self.rate_hz = float(rate_hz)
+        self.depth = float(depth)
+        self.phase_step = 2 * np.pi * self.rate_hz / sample_rate
+        self.phase = 0.0
+
+    @classmethod
+    def design(cls, params, sample_rate):
+        return {}
+
+    @classmethod
+    def from_params(cls, params, coeffs, sample_rate):
+        return cls(params["rate_hz"], params["depth"], sample_rate=sample_rate)
+
+    def reset(self, channels=()):
+        # The phase follows the stream clock, not the signal
+        pass
+
+    def seek(self, position):
+        """Set the LFO phase to where it would be ``position`` samples into the stream"""
+        self.phase = (self.phase_step * position) % (2 * np.pi)
+
+    def advance(self, frames):
+        """Keep the LFO running through blocks the chain skipped"""
+        self.phase = (self.phase + self.phase_step * frames) % (2 * np.pi)
+
+    def process(self, audio_data):
+        gain = kernels.lfo_gain(len(audio_data), self.phase, self.phase_step, self.depth)
+        self.phase = (self.phase + self.phase_step * len(audio_data)) % (2 * np.pi)
+        return audio_data * gain.reshape((len(gain),) + (1,) * (audio_data.ndim - 1))
+
+
+class TimeStretchStage:
+    """WSOLA speaking-rate stage
+
+    ``stretch`` changes the duration of a whole recording by ``1 / rate``
+    (offline conversions). ``process`` keeps the live block size: output
+    goes through an elastic FIFO that may run up to ``max_backlog`` samples
+    ahead of real time. Speech frames play at ``rate``; pauses absorb the
+    drift, shrinking or stretching to bring the FIFO back to ``target``.
+    Once the backlog bound is reached, slow speech plays at normal speed
+    (and fast speech likewise when the FIFO runs dry) rather than letting
+    the latency grow.
+    """
+
+    def __init__(self, rate, sample_rate=Config.SAMPLE_RATE):
+        self.rate = float(rate)
+        self.core = WSOLA()
+        self.target = int(Config.STRETCH_TARGET_SECONDS * sample_rate)
+        self.max_backlog = int(Config.STRETCH_MAX_SECONDS * sample_rate)
+        self.bypass = False
+        self.reset()
+
+    @classmethod
+    def design(cls, params, sample_rate):
+        return {}
+
+    @classmethod
+    def from_params(cls, params, coeffs, sample_rate):
+        return cls(params["rate"], sample_rate=sample_rate)
+
+    @property
+    def latency(self):
+        if self.bypass or self.rate == 1.0:
+            return 0
+        return self.core.frame_size + self.core.tolerance + self.target
+
+    @property
+    def pending(self):
+        """Slowed speech buffered beyond the nominal latency, in samples
+
+        Input not yet analysed plus the FIFO, minus ``latency`` and the few
+        hops of jitter the FIFO keeps while idling.
+        """
+        if self.bypass or self.rate == 1.0:
+            return 0
+        buffered = len(self._fifo) + self.core.end - int(round(self._analysis))
+        return max(0, buffered - self.latency - 3 * self.core.hop)
+
+    def reset(self, channels=()):
+        self._channels = tuple(channels)
+        self.core.reset(self._channels)
+        self._analysis = 0.0
+        self._fifo = np.zeros((0,) + self._channels)
+        self._primed = False
+
+    def decay(self, factor):
+        self.core.decay(factor)
+        self._fifo *= factor
+
+    def stretch(self, audio_data):
+        """Offline: the whole recording at ``rate`` (duration scales by 1 / rate)"""
+        audio_data = np.asarray(audio_data)
+        core = WSOLA(self.core.frame_size, self.core.tolerance)
+        core.reset(audio_data.shape[1:])
+        padding = 2 * core.frame_size + core.tolerance
+        core.push(np.concatenate([audio_data, np.zeros((padding,) + audio_data.shape[1:])]))
+        
+        length = int(round(len(audio_data) / self.rate))
+        chunks = []
+        analysis = 0.0
+        while len(chunks) * core.hop < length and core.ready(int(round(analysis))):
+            chunks.append(core.frame(int(round(analysis))))
+            analysis += core.hop * self.rate
+        
+        output = np.zeros((length,) + audio_data.shape[1:], dtype=audio_data.dtype)
+        stretched = np.concatenate(chunks)[:length] if chunks else output[:0]
+        output[:len(stretched)] = stretched
+        return output
+
+    def _frame_rate(self, level, backlog):
+        """Analysis rate for the next frame given its level and the FIFO backlog"""
+        hop = self.core.hop
+        if level > Config.GATE_CLOSE_DB:
+            rate = self.rate
+        elif backlog > self.target + hop:
+            rate = Config.STRETCH_CATCHUP_RATE
+        elif backlog < self.target - hop:
+            rate = 1.0 / Config.STRETCH_CATCHUP_RATE
+        else:
+            rate = 1.0
+        
+        if backlog >= self.max_backlog:
+            rate = max(rate, 1.0)
+        elif backlog <= hop:
+            rate = min(rate, 1.0)
+        return rate
+
+    def process(self, audio_data):
+        if self.bypass or self.rate == 1.0:
+            return audio_data
+        if audio_data.shape[1:] != self._channels:
+            self.reset(audio_data.shape[1:])
+        
+        count = len(audio_data)
+        self.core.push(audio_data)
+        chunks = [self._fifo]
+        backlog = len(self._fifo) - count
+        while self.core.ready(int(round(self._analysis))):
+            position = int(round(self._analysis))
+            rate = self._frame_rate(self.core.level_db(position), backlog)
+            chunks.append(self.core.frame(position))
+            backlog += self.core.hop
+            self._analysis += self.core.hop * rate
+        fifo = np.concatenate(chunks)
+        
+        # Prime to the target backlog before playing; re-prime after an underrun
+        if not self._primed:
+            self._primed = len(fifo) >= count + self.target
+            if not self._primed:
+                self._fifo = fifo
+                return np.zeros(audio_data.shape)
+        
+        output = np.zeros(audio_data.shape)
+        available = min(count, len(fifo))
+        output[:available] = fifo[:available]
+        self._fifo = fifo[available:]
+        if available < count:
+            self._primed = False
+        return output
+
+
+STAGE_TYPES = {
+    "stretch": TimeStretchStage,
+    "pitch": PitchShiftStage,
+    "formant": FormantWarper,
+    "filter": FilterStage,
+    "tremolo": TremoloStage,
+    "compressor": DynamicsProcessor,
+    "convolution": PartitionedConvolver,
+}
+
+# ================================
+# CHARACTER LIBRARY
+# ================================
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _valid_cutoff(value):
+    """One positive corner frequency, or an ascending [low, high] pair"""
+    if _is_number(value):
+        return value > 0
+    return (isinstance(value, list) and len(value) == 2 and all(_is_number(v) for v in value)
+            and 0 < value[0] < value[1])
+
+
+# Stage parameters per stage type, same layout as CHARACTER_SCHEMA
+STAGE_SCHEMAS = {
+    "stretch": {
+        "rate": ((int, float), True, lambda v: 0.25 <= v <= 4.0),
+    },
+    "pitch": {
+        "factor": ((int, float), True, lambda v: 0.25 <= v <= 4.0),
+    },
+    "formant": {
+        "factor": ((int, float), True, lambda v: 0.5 <= v <= 2.0),
+        "method": (str, True, lambda v: v in FormantWarper.METHODS),
+    },
+    "filter": {
+        "btype": (str, True, lambda v: v in ("lowpass", "highpass", "bandpass", "bandstop")),
+        "order": (int, True, lambda v: 1 <= v <= 12),
+        "cutoff": ((int, float, list), True, _valid_cutoff),
+        "mix": ((int, float), False, lambda v: 0.0 <= v <= 4.0),
+    },
+    "tremolo": {
+        "rate_hz": ((int, float), True, lambda v: 0 < v <= 50),
+        "depth": ((int, float), True, lambda v: 0.0 <= v <= 1.0),
+    },
+    "compressor": {
+        "threshold_db": ((int, float), False, lambda v: -80 <= v <= 0),
+        "ratio": ((int, float), False, lambda v: v >= 1.0),
+        "knee_db": ((int, float), False, lambda v: 0 <= v <= 24),
+        "attack_ms": ((int, float), False, lambda v: 0 < v <= 500),
+        "release_ms": ((int, float), False, lambda v: 0 < v <= 5000),
+        "lookahead_ms": ((int, float), False, lambda v: 0 <= v <= 20),
+        "makeup_db": ((int, float), False, lambda v: -24 <= v <= 24),
+    },
+    "convolution": {
+        "impulse_response": (str, True, None),
+        "partition": (int, False, lambda v: v > 0 and v & (v - 1) == 0),
+        "wet": ((int, float), False, lambda v: 0.0 <= v <= 4.0),
+        "dry": ((int, float), False, lambda v: 0.0 <= v <= 4.0),
+    },
+}
+
+# Field: (accepted types, required, validator or None)
+CHARACTER_SCHEMA = {
+    "name": (str, True, None),
+    "pitch_factor": ((int, float), True, lambda v: 0.25 <= v <= 4.0),
+    "formant_shift": ((int, float), True, lambda v: 0.5 <= v <= 2.0),
+    "formant_method": (str, False, lambda v: v in ("filter",) + FormantWarper.METHODS),
+    "speaking_rate": ((int, float), True, lambda v: 0.25 <= v <= 4.0),
+    # Absolute targets used instead of the fixed shifts once a user's voice profile is known
+    "target_f0": ((int, float), False, lambda v: 40 <= v <= 1000),
+    "target_centroid": ((int, float), False, lambda v: 200 <= v <= 6000),
+    "target_lufs": ((int, float), False, lambda v: -40 <= v <= -5),
+    "tone_profile": (str, True, lambda v: v in Config.TONE_PROFILES),
+    "compressor": (dict, False, None),
+    "stages": (list, False, None),
+}
+
+
+def _check_fields(spec, schema, where=""):
+    """Check one table against a schema, raising ValueError"""
+    unknown = set(spec) - set(schema)
+    if unknown:
+        raise ValueError(f"{where}unknown fields: {', '.join(sorted(unknown))}")
+    
+    for field, (types, required, check) in schema.items():
+        if field not in spec:
+            if required:
+                raise ValueError(f"{where}missing required field '{field}'")
+            continue
+        value = spec[field]
+        if isinstance(value, bool) or not isinstance(value, types):
+            raise ValueError(f"{where}field '{field}' has invalid type {type(value).__name__}")
+        if check is not None and not check(value):
+            raise ValueError(f"{where}field '{field}' has invalid value {value!r}")
+
+
+def validate_character(spec):
+    """Check a character definition and its stage parameters, raising ValueError"""
+    if not isinstance(spec, dict):
+        raise ValueError("character definition must be a table/object")
+    _check_fields(spec, CHARACTER_SCHEMA)
+    
+    if "compressor" in spec:
+        _check_fields(spec["compressor"], STAGE_SCHEMAS["compressor"], "compressor: ")
+    for index, stage in enumerate(spec.get("stages", [])):
+        if not isinstance(stage, dict) or stage.get("type") not in STAGE_TYPES:
+            raise ValueError(f"stage {index} needs a type out of {', '.join(STAGE_TYPES)}")
+        params = {key: value for key, value in stage.items() if key != "type"}
+        _check_fields(params, STAGE_SCHEMAS[stage["type"]], f"stage {index} ({stage['type']}): ")
+    return spec
+
+
+class CharacterChain:
+    """Compiled, stateful processing chain for one character"""
+
+    def __init__(self, key, spec, stages, plan):
+        self.key = key
+        self.spec = spec
+        self.stages = stages
+        self.plan = plan
+        self.stage_time = [0.0] * len(stages)
+
+    @property
+    def latency(self):
+        """Total processing delay in samples"""
+        return sum(stage.latency for stage in self.stages)
+
+    @property
+    def tail(self):
+        """Samples of past input that can still reach the output"""
+        return self.latency + sum(getattr(stage, "tail", 0) for stage in self.stages)
+
+    @property
+    def pending(self):
+        """Delayed audio still buffered beyond the latency (elastic speaking-rate FIFO)"""
+        return sum(getattr(stage, "pending", 0) for stage in self.stages)
+
+    def find_stage(self, stage_type):
+        """First stage of the given class, or None"""
+        for stage in self.stages:
+            if isinstance(stage, stage_type):
+                return stage
+        return None
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+
+    def decay(self, factor):
+        """Shrink stage state towards silence without processing audio"""
+        for stage in self.stages:
+            if hasattr(stage, "decay"):
+                stage.decay(factor)
+
+    def seek(self, position):
+        """Align position-dependent state (LFO phase, pitch grid) with a stream offset"""
+        for stage in self.stages:
+            if hasattr(stage, "seek"):
+                stage.seek(position)
+
+    def advance(self, frames):
+        """Move position-dependent state past blocks that were not processed"""
+        for stage in self.stages:
+            if hasattr(stage, "advance"):
+                stage.advance(frames)
+
+    def process(self, audio_data):
+        """Run one block through every stage"""
+        for index, stage in enumerate(self.stages):
+            start = time.perf_counter()
+            audio_data = stage.process(audio_data)
+            self.stage_time[index] += time.perf_counter() - start
+        return audio_data
+
+
+class CharacterCompiler:
+    """Turns character definitions into processing chains
+
+    Filter designs are cached on disk under a hash of the compiled plan, so
+    a chain whose definition did not change loads its coefficients instead
+    of redesigning them. Formant warp matrices are rebuilt from the factor
+    instead: that takes less time than reading the dense matrix back.
+    """
+
+    CACHE_VERSION = 2
+
+    def __init__(self, cache_dir=Config.CHAIN_CACHE_DIR, sample_rate=Config.SAMPLE_RATE):
+        self.cache_dir = Path(cache_dir)
+        self.sample_rate = sample_rate
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def plan(self, spec):
+        """Expand a character definition into a list of stage parameter dicts"""
+        stages = []
+        if spec["speaking_rate"] != 1.0:
+            stages.append({"type": "stretch", "rate": spec["speaking_rate"]})
+        if spec["pitch_factor"] != 1.0:
+            stages.append({"type": "pitch", "factor": spec["pitch_factor"]})
+        
+        factor = spec["formant_shift"]
+        if factor != 1.0:
+            method = spec.get("formant_method", "filter")
+            if method != "filter":
+                stages.append({"type": "formant", "factor": factor, "method": method})
+            elif factor > 1.0:
+                # Higher formants - brighter voice
+                stages.append({"type": "filter", "btype": "bandpass", "order": 4,
+                               "cutoff": [200, 3000 * factor]})
+            else:
+                # Lower formants - deeper voice
+                stages.append({"type": "filter", "btype": "lowpass", "order": 4,
+                               "cutoff": 2000 * factor})
+        
+        stages.extend(dict(stage) for stage in Config.TONE_PROFILES[spec["tone_profile"]])
+        stages.extend(dict(stage) for stage in spec.get("stages", []))
+        
+        if "compressor" in spec:
+            stages.append({"type": "compressor", **spec["compressor"]})
+        return stages
+
+    def plan_hash(self, plan):
+        payload = json.dumps({
+            "version": self.CACHE_VERSION,
+            "sample_rate": self.sample_rate,
+            "formant_frame": [Config.FORMANT_FRAME_SIZE, Config.FORMANT_HOP_SIZE],
+            "plan": plan,
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _load_coefficients(self, key):
+        path = self.cache_dir / f"{key}.npz"
+        if not path.exists():
+            return None
+        try:
+            with np.load(path) as data:
+                return {name: data[name] for name in data.files}
+        except Exception as e:
+            logging.warning(f"Ignoring corrupt chain cache {path}: {e}")
+            return None
+
+    def _store_coefficients(self, key, arrays):
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # Unique per thread: offline renders share the compiler
+            tmp_path = self.cache_dir / f"{key}.{os.getpid()}-{threading.get_ident()}.tmp.npz"
+            np.savez(tmp_path, **arrays)
+            os.replace(tmp_path, self.cache_dir / f"{key}.npz")
+        except OSError as e:
+            logging.warning(f"Could not write chain cache: {e}")
+
+    def compile(self, spec, cache=True):
+        """Build a fresh CharacterChain for a validated character definition
+
+        ``cache=False`` designs from scratch without touching the disk cache
+        (one-off definitions such as profile-adapted characters).
+        """
+        plan = self.plan(spec)
+        key = self.plan_hash(plan)
+        
+        arrays = self._load_coefficients(key) if cache else None
+        if arrays is None:
+            self.cache_misses += 1
+            arrays = {}
+            for index, params in enumerate(plan):
+                stage_type = STAGE_TYPES[params["type"]]
+                for name, value in stage_type.design(params, self.sample_rate).items():
+                    arrays[f"{index}.{name}"] = value
+            if cache:
+                self._store_coefficients(key, arrays)
+        else:
+            self.cache_hits += 1
+        
+        stages = []
+        for index, params in enumerate(plan):
+            stage_type = STAGE_TYPES[params["type"]]
+            prefix = f"{index}."
+            coeffs = {name[len(prefix):]: value for name, value in arrays.items()
+                      if name.startswith(prefix)}
+            options = {k: v for k, v in params.items() if k != "type"}
+            stages.append(stage_type.from_params(options, coeffs, self.sample_rate))
+        
+        return CharacterChain(key, spec, stages, plan)
+
+
+class CharacterLibrary:
+    """Character definitions: built-ins plus JSON/TOML files from a directory
+
+    Each ``<key>.json`` or ``<key>.toml`` file in the directory defines (or
+    overrides) the character ``<key>``. A file is read, validated and
+    compiled once per (mtime, size); files that fail are logged once,
+    listed in ``errors`` and skipped. ``directory=None`` gives the
+    built-ins only. Offline renders share the bot's library (and its
+    compiler) instead of loading their own.
+    """
+
+    def __init__(self, directory=Config.CHARACTERS_DIR, compiler=None):
+        self.directory = Path(directory) if directory is not None else None
+        self.compiler = compiler or CharacterCompiler()
+        self.characters = {}
+        self.errors = {}
+        self._files = {}
+        self._signature = None
+        self._reload_lock = threading.Lock()
+        self._watcher = None
+        self._watch_stop = threading.Event()
+        self.reload()
+
+    def _scan(self):
+        if self.directory is None or not self.directory.is_dir():
+            return []
+        return sorted(p for p in self.directory.iterdir()
+                      if p.suffix in (".json", ".toml") and p.is_file())
+
+    def _signature_of(self, paths):
+        signature = []
+        for path in paths:
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            signature.append((path.name, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    @staticmethod
+    def _read(path):
+        if path.suffix == ".toml":
+            if tomllib is None:
+                raise ValueError("TOML support needs Python 3.11+")
+            with open(path, "rb") as f:
+                return tomllib.load(f)
+        with open(path) as f:
+            return json.load(f)
+
+    def reload(self):
+        """Re-read the directory; returns the keys that were added/changed/removed
+
+        Serialized, since the watcher thread and ``.voice reload`` can both call it.
+        """
+        with self._reload_lock:
+            paths = self._scan()
+            characters = {key: dict(spec) for key, spec in Config.VOICE_CHARACTERS.items()}
+            errors = {}
+            files = {}
+            
+            for path in paths:
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                signature = (stat.st_mtime_ns, stat.st_size)
+                entry = self._files.get(path.name)
+                if entry is None or entry[0] != signature:
+                    try:
+                        spec = validate_character(self._read(path))
+                        self.compiler.compile(spec)
+                        entry = (signature, spec, None)
+                    except Exception as e:
+                        logging.error(f"Invalid character file {path.name}: {e}")
+                        entry = (signature, None, str(e))
+            
+                files[path.name] = entry
+                if entry[2] is None:
+                    characters[path.stem] = entry[1]
+                else:
+                    errors[path.name] = entry[2]
+            
+            changed = {key for key in characters
+                       if key not in self.characters or self.characters[key] != characters[key]}
+            removed = set(self.characters) - set(characters)
+            
+            self.characters = characters
+            self.errors = errors
+            self._files = files
+            self._signature = self._signature_of(paths)
+            return changed | removed
+
+    def start_watching(self, on_change, interval=Config.CHARACTER_WATCH_INTERVAL):
+        """Poll the directory and call ``on_change(keys)`` after a live reload"""
+        if self._watcher is not None:
+            return
+        
+        def watch():
+            while not self._watch_stop.wait(interval):
+                if self._signature_of(self._scan()) == self._signature:
+                    continue
+                keys = self.reload()
+                if keys:
+                    logging.info(f"Characters reloaded: {', '.join(sorted(keys))}")
+                    on_change(keys)
+        
+        self._watch_stop.clear()
+        self._watcher = threading.Thread(target=watch, name="character-watcher", daemon=True)
+        self._watcher.start()
+
+    def stop_watching(self):
+        self._watch_stop.set()
+        self._watcher = None
+
+# ================================
+# VOICE ACTIVITY GATE
+# ================================
+
+class VoiceActivityGate:
+    """Energy / zero-crossing voice-activity detector with a fading noise gate
+
+    Opens above ``open_db`` and closes below ``close_db`` (hysteresis), but
+    only after ``hangover_ms`` without activity. Blocks that are quiet and
+    noise-like (high zero-crossing rate) do not count as activity. While
+    closed the caller can skip the processing chain entirely.
+    """
+
+    def __init__(self, open_db=Config.GATE_OPEN_DB, close_db=Config.GATE_CLOSE_DB,
+                 hangover_ms=Config.GATE_HANGOVER_MS, fade_ms=Config.GATE_FADE_MS,
+                 max_zcr=Config.GATE_MAX_ZCR, sample_rate=Config.SAMPLE_RATE):
+        self.open_db = open_db
+        self.close_db = close_db
+        self.max_zcr = max_zcr
+        self.hangover = int(hangover_ms * sample_rate / 1000)
+        self.fade_step = 1000.0 / max(fade_ms * sample_rate, 1.0)
+        # Chain state is decayed for this long while closed, then reset once
+        self.settle = int(0.25 * sample_rate)
+        
+        self.is_open = False
+        self.gain = 0.0
+        self.level_db = -120.0
+        self.zcr = 0.0
+        self._hangover_left = 0
+        self._idle_samples = 0
+        self.blocks = 0
+        self.skipped = 0
+
+    @property
+    def idle_ratio(self):
+        """Share of blocks that skipped the processing chain"""
+        return self.skipped / self.blocks if self.blocks else 0.0
+
+    def update(self, block, pending=0):
+        """Classify a block; returns False when the chain can be skipped
+
+        ``pending`` is audio the chain still holds beyond its latency; the
+        gate stays open until it has played out.
+        """
+        n = len(block)
+        self.blocks += 1
+        self.level_db = 10 * np.log10(np.mean(np.square(block)) + 1e-12)
+        
+        first = block if block.ndim == 1 else block[:, 0]
+        self.zcr = np.count_nonzero(np.diff(np.signbit(first))) / max(n - 1, 1)
+        
+        threshold = self.close_db if self.is_open else self.open_db
+        noise_like = self.zcr > self.max_zcr and self.level_db < self.open_db + 10
+        if self.level_db > threshold and not noise_like:
+            self.is_open = True
+            self._hangover_left = self.hangover
+        elif self.is_open:
+            self._hangover_left -= n
+            if self._hangover_left <= 0 and pending <= 0:
+                self.is_open = False
+        
+        # Keep processing until the fade-out has reached silence
+        if self.is_open or self.gain > 0.0:
+            self._idle_samples = 0
+            return True
+        self.skipped += 1
+        return False
+
+    def apply(self, processed):
+        """Fade the processed block in/out in place towards the gate target"""
+        target = 1.0 if self.is_open else 0.0
+        if self.gain == target:
+            return processed
+        
+        direction = 1.0 if target > self.gain else -1.0
+        ramp = self.gain + direction * self.fade_step * np.arange(1, len(processed) + 1)
+        np.clip(ramp, 0.0, 1.0, out=ramp)
+        processed *= ramp.reshape((len(ramp),) + (1,) * (processed.ndim - 1))
+        self.gain = float(ramp[-1])
+        return processed
+
+    def hold(self, samples):
+        """Keep an open gate open for at least ``samples`` more (flushing a tail)"""
+        if self.is_open:
+            self._hangover_left = max(self._hangover_left, samples)
+
+    def idle(self, chain, frames):
+        """Let chain state die away cheaply while the gate is closed"""
+        if chain is None:
+            return
+        chain.advance(frames)
+        if self._idle_samples > self.settle:
+            return
+        self._idle_samples += frames
+        if self._idle_samples > self.settle:
+            chain.reset()
+        else:
+            chain.decay(0.5)
+
+# ================================
+# LATENCY AUTO-TUNING
+# ================================
+
+class LatencyAutoTuner:
+    """Picks the smallest block size and stream latency that keep a safety margin
+
+    At start the character chain is benchmarked at every candidate block
+    size and the smallest one whose p99 callback time stays under
+    ``target_load`` of the block period is chosen. At runtime the callback
+    reports its duration and xrun flags; a monitor thread escalates (more
+    stream latency first, then a larger block) on xruns or overload and
+    relaxes again after a calm period.
+    """
+
+    def __init__(self, sample_rate=Config.SAMPLE_RATE, candidates=Config.BLOCK_SIZE_CANDIDATES,
+                 target_load=Config.TUNE_TARGET_LOAD, latency_blocks=Config.TUNE_LATENCY_BLOCKS):
+        self.sample_rate = sample_rate
+        self.candidates = sorted(candidates)
+        self.target_load = target_load
+        self.latency_blocks = latency_blocks
+        
+        self.blocksize = Config.BUFFER_SIZE
+        self.latency_index = 0
+        self.benchmarks = {}
+        self.allowed = list(self.candidates)
+        
+        # Written by the audio callback only
+        self._durations = np.zeros(512)
+        self._count = 0
+        self.xruns = 0
+        self._window_xruns = 0
+        
+        self.load = 0.0
+        self._calm_windows = 0
+        self._relax_after = Config.TUNE_RELAX_WINDOWS
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def period(self):
+        return self.blocksize / self.sample_rate
+
+    @property
+    def latency(self):
+        """Suggested PortAudio stream latency in seconds"""
+        return self.period * self.latency_blocks[self.latency_index]
+
+    def benchmark(self, make_processor, key, channels=()):
+        """Time a fresh processor at every candidate size; returns the chosen block size"""
+        if key not in self.benchmarks:
+            rng = np.random.default_rng(0)
+            loads = {}
+            for size in self.candidates:
+                process = make_processor()
+                block = 0.1 * rng.standard_normal((size,) + tuple(channels))
+                for _ in range(5):
+                    process(block.copy())
+                
+                timings = []
+                for _ in range(max(20, int(0.25 * self.sample_rate / size))):
+                    start = time.perf_counter()
+                    process(block.copy())
+                    timings.append(time.perf_counter() - start)
+                loads[size] = float(np.percentile(timings, 99)) * self.sample_rate / size
+            self.benchmarks[key] = loads
+        
+        loads = self.benchmarks[key]
+        self.allowed = [size for size in self.candidates if loads[size] <= self.target_load]
+        if not self.allowed:
+            self.allowed = [self.candidates[-1]]
+        self.blocksize = self.allowed[0]
+        self.latency_index = 0
+        self.reset_window()
+        logging.info(f"Auto-tune: block {self.blocksize}, "
+                     f"benchmark loads {', '.join(f'{s}={l:.0%}' for s, l in loads.items())}")
+        return self.blocksize
+
+    def reset_window(self):
+        self._count = 0
+        self._window_xruns = 0
+
+    def observe(self, duration, status):
+        """Record one callback (audio thread; no locks, no allocation)"""
+        self._durations[self._count % len(self._durations)] = duration
+        self._count += 1
+        if status and (status.input_overflow or status.output_underflow):
+            self.xruns += 1
+            self._window_xruns += 1
+
+    def evaluate(self):
+        """Adjust block size / latency from the last window; True if they changed"""
+        count = min(self._count, len(self._durations))
+        xruns = self._window_xruns
+        if count == 0:
+            return False
+        self.load = float(np.percentile(self._durations[:count], 99)) / self.period
+        self.reset_window()
+        
+        if xruns or self.load > self.target_load:
+            self._calm_windows = 0
+            self._relax_after = min(self._relax_after * 2, 64 * Config.TUNE_RELAX_WINDOWS)
+            if self.latency_index < len(self.latency_blocks) - 1:
+                self.latency_index += 1
+                return True
+            larger = [size for size in self.candidates if size > self.blocksize]
+            if larger:
+                self.blocksize = larger[0]
+                self.latency_index = 0
+                return True
+            return False
+        
+        self._calm_windows += 1
+        if self._calm_windows < self._relax_after or self.load > self.target_load / 2:
+            return False
+        
+        self._calm_windows = 0
+        if self.latency_index > 0:
+            self.latency_index -= 1
+            return True
+        smaller = [size for size in self.allowed if size < self.blocksize]
+        if smaller:
+            self.blocksize = smaller[-1]
+            return True
+        return False
+
+    def start(self, on_change, interval=Config.TUNE_INTERVAL):
+        """Evaluate every ``interval`` seconds and call ``on_change()`` on renegotiation"""
+        if self._thread is not None:
+            return
+        
+        def monitor():
+            while not self._stop.wait(interval):
+                if self.evaluate():
+                    logging.info(f"Auto-tune: renegotiating block {self.blocksize}, "
+                                 f"latency {self.latency * 1000:.1f} ms (load {self.load:.0%})")
+                    on_change()
+        
+        self._stop.clear()
+        self._thread = threading.Thread(target=monitor, name="latency-tuner", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+# ================================
+# STREAM LIFECYCLE
+# ================================
+
+class StreamManager:
+    """Owns every PortAudio stream the process opens
+
+    Streams are keyed by device, so there is at most one per device. Opening
+    and closing are synchronous and serialised by a lock: ``open`` returns
+    once the stream is running and ``close`` once its handle is released
+    (``abort`` drops pending buffers instead of draining them, so this takes
+    milliseconds). Every stream is tracked until closed, and ``close_all``
+    runs at interpreter exit, so handles cannot leak.
+    """
+
+    def __init__(self):
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def open(self, device, factory, replace=True):
+        """Start ``factory()``'s stream on ``device``; an existing one is closed first
+
+        With ``replace=False`` a busy device raises instead.
+        """
+        with self._lock:
+            if device in self._streams:
+                if not replace:
+                    raise RuntimeError(f"Audio device {device or 'default'} is already in use")
+                self._close(device)
+            stream = factory()
+            try:
+                stream.start()
+            except Exception:
+                stream.close(ignore_errors=True)
+                raise
+            self._streams[device] = stream
+            return stream
+
+    def _close(self, device):
+        stream = self._streams.pop(device, None)
+        if stream is not None:
+            try:
+                stream.abort(ignore_errors=True)
+            finally:
+                stream.close(ignore_errors=True)
+
+    def close(self, device):
+        with self._lock:
+            self._close(device)
+
+    def close_all(self):
+        with self._lock:
+            for device in list(self._streams):
+                self._close(device)
+
+    def is_open(self, device):
+        return device in self._streams
+
+
+audio_streams = StreamManager()
+atexit.register(audio_streams.close_all)
+
+# ================================
+# OUTPUT SINKS
+# ================================
+
+class PCMRing:
+    """Preallocated ring of s16le PCM blocks shared by all output sinks
+
+    The audio callback is the only writer. Each consumer holds its own
+    cursor (``RingReader``), so a slow consumer never holds up the callback
+    or the other sinks: when it falls more than a ring's worth behind,
+    its oldest blocks are dropped.
+    """
+
+    def __init__(self, slots=Config.SINK_QUEUE_BLOCKS, max_frames=Config.SINK_MAX_BLOCK, channels=1):
+        self.slots = slots
+        self.channels = channels
+        self.buffers = np.zeros((slots, max_frames, channels), dtype=np.int16)
+        self.lengths = np.zeros(slots, dtype=np.int64)
+        self._scratch = np.zeros((max_frames, channels), dtype=np.float32)
+        self.seq = 0
+
+    def write(self, block):
+        """Convert a float block into the next slot (called from the audio thread)"""
+        n = min(len(block), self.buffers.shape[1])
+        slot = self.seq % self.slots
+        scratch = self._scratch[:n]
+        np.multiply(block[:n].reshape(n, -1), 32767.0, out=scratch)
+        np.copyto(self.buffers[slot, :n], scratch, casting="unsafe")
+        self.lengths[slot] = n
+        self.seq += 1
+
+    def view(self, seq):
+        """Zero-copy memoryview of the PCM bytes of block ``seq``"""
+        slot = seq % self.slots
+        return memoryview(self.buffers[slot, :self.lengths[slot]]).cast("B")
+
+
+class RingReader:
+    """Bounded, drop-oldest cursor into a PCMRing"""
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.cursor = ring.seq
+        self.dropped = 0
+
+    @property
+    def backlog(self):
+        return self.ring.seq - self.cursor
+
+    def read(self):
+        """Next block as a memoryview, or None when caught up
+
+        The view stays valid until the writer laps it; consume it before
+        reading again.
+        """
+        # Keep one slot of headroom for the block being written
+        behind = self.ring.seq - self.cursor
+        if behind >= self.ring.slots:
+            skip = behind - (self.ring.slots - 1)
+            self.cursor += skip
+            self.dropped += skip
+        if self.cursor >= self.ring.seq:
+            return None
+        view = self.ring.view(self.cursor)
+        self.cursor += 1
+        return view
+
+
+class OutputSink:
+    """Base class for consumers of the processed audio stream"""
+
+    kind = "sink"
+
+    def __init__(self, ring):
+        self.reader = RingReader(ring)
+
+    @property
+    def dropped(self):
+        return self.reader.dropped
+
+    def describe(self):
+        return self.kind
+
+    def start(self):
+        pass
+
+    def notify(self):
+        """A new block is available (called from the audio thread, must not block)"""
+
+    def stop(self):
+        pass
+
+
+class PipeSink(OutputSink):
+    """Writes raw s16le PCM to a FIFO, pipe or file from a writer thread"""
+
+    kind = "pipe"
+
+    def __init__(self, ring, path):
+        super().__init__(ring)
+        self.path = Path(path)
+        self._ready = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._created = False
+
+    def describe(self):
+        return f"pipe {self.path}"
+
+    def start(self):
+        if not self.path.exists() and hasattr(os, "mkfifo"):
+            os.mkfifo(self.path)
+            self._created = True
+        self._thread = threading.Thread(target=self._run, name=f"sink-{self.path.name}", daemon=True)
+        self._thread.start()
+
+    def notify(self):
+        self._ready.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._ready.set()
+        if self._thread is None:
+            return
+        # A writer still waiting for a reader in open() only wakes once one attaches
+        unblock = None
+        if self._thread.is_alive() and self.path.is_fifo():
+            try:
+                unblock = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+            except OSError:
+                pass
+        self._thread.join(timeout=1.0)
+        if unblock is not None:
+            os.close(unblock)
+        self._thread = None
+        if self._created:
+            self.path.unlink(missing_ok=True)
+            self._created = False
+
+    def _run(self):
+        try:
+            # Opening a FIFO blocks until a reader attaches; skip what we miss meanwhile
+            with open(self.path, "wb", buffering=0) as pipe:
+                self.reader.cursor = self.reader.ring.seq
+                while not self._stopped.is_set():
+                    self._ready.wait()
+                    self._ready.clear()
+                    view = self.reader.read()
+                    while view is not None and not self._stopped.is_set():
+                        pipe.write(view)
+                        view = self.reader.read()
+        except (BrokenPipeError, OSError) as e:
+            logging.warning(f"Pipe sink {self.path} closed: {e}")
+
+
+class SoundDeviceSink(OutputSink):
+    """Plays the processed stream on another device (e.g. a virtual loopback device)
+
+    The device block size is fixed when the stream opens while the engine's
+    may change (``tune_blocksize``), so the callback fills ``outdata`` from
+    as many ring blocks as it needs and keeps a byte cursor into the one it
+    stopped in.
+    """
+
+    kind = "device"
+
+    def __init__(self, ring, device, sample_rate=Config.SAMPLE_RATE, blocksize=Config.BUFFER_SIZE):
+        super().__init__(ring)
+        self.device = device
+        self.sample_rate = sample_rate
+        self.blocksize = blocksize
+        self.stream = None
+        self._silence = bytes(blocksize * ring.channels * 2)
+        self._pending = None
+        self._offset = 0
+
+    def describe(self):
+        return f"device {self.device}"
+
+    def _callback(self, outdata, frames, time_info, status):
+        filled, size = 0, len(outdata)
+        while filled < size:
+            if self._pending is None:
+                self._pending = self.reader.read()
+                self._offset = 0
+                if self._pending is None:
+                    break
+            n = min(len(self._pending) - self._offset, size - filled)
+            outdata[filled:filled + n] = self._pending[self._offset:self._offset + n]
+            filled += n
+            self._offset += n
+            if self._offset == len(self._pending):
+                self._pending = None
+        if filled < size:
+            outdata[filled:] = self._silence[:size - filled]
+
+    def start(self):
+        if sd is None:
+            raise RuntimeError("sounddevice/PortAudio not available")
+        self._pending = None
+        self.stream = audio_streams.open(
+            self.device,
+            lambda: sd.RawOutputStream(device=self.device, samplerate=self.sample_rate,
+                                       blocksize=self.blocksize, channels=self.reader.ring.channels,
+                                       dtype="int16", callback=self._callback),
+            replace=False)
+
+    def stop(self):
+        if self.stream is not None:
+            audio_streams.close(self.device)
+            self.stream = None
+
+
+class AsyncStreamSink(OutputSink):
+    """In-memory stream for asyncio consumers (e.g. a voice-chat client library)
+
+    Usage::
+
+        sink = engine.open_async_sink(asyncio.get_running_loop())
+        async for pcm in sink:      # memoryview of s16le frames
+            await call.send(pcm)
+    """
+
+    kind = "stream"
+
+    def __init__(self, ring, loop):
+        super().__init__(ring)
+        self.loop = loop
+        self._event = asyncio.Event()
+        self._waiting = False
+        self._closed = False
+
+    def notify(self):
+        # Only pay for the cross-thread wakeup when the consumer is parked
+        if self._waiting:
+            self._waiting = False
+            self.loop.call_soon_threadsafe(self._event.set)
+
+    def stop(self):
+        self._closed = True
+        self.loop.call_soon_threadsafe(self._event.set)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            view = self.reader.read()
+            if view is not None:
+                return view
+            if self._closed:
+                raise StopAsyncIteration
+            self._event.clear()
+            self._waiting = True
+            await self._event.wait()
+
+# ================================
+# VOICE PROCESSING ENGINE
+# ================================
+
+class VoiceCloneEngine:
+    def __init__(self, channels=Config.CHANNELS, channel_mode=Config.CHANNEL_MODE, library=None):
+        self.is_active = False
+        self.current_character = "normal"
+        self.audio_thread = None
+        self.input_stream = None
+        self.output_stream = None
+        self.processing_lock = threading.Lock()
+        
+        # Audio processing parameters
+        self.sample_rate = Config.SAMPLE_RATE
+        self.buffer_size = Config.BUFFER_SIZE
+        self.channels = channels
+        self.channel_mode = channel_mode
+        
+        # Voice modification buffers
+        self.audio_buffer = np.zeros(self.buffer_size * 4)
+        self.buffer_index = 0
+        
+        # Character definitions (shared when given) and this engine's compiled (stateful) chains
+        if library is None:
+            library = CharacterLibrary(Config.CHARACTERS_DIR,
+                                       CharacterCompiler(Config.CHAIN_CACHE_DIR, self.sample_rate))
+        self.library = library
+        self.compiler = library.compiler
+        self.chains = {}
+        
+        # Loudness makeup gain, then the final output limiter
+        self.normalizer = LoudnessNormalizer(self.sample_rate)
+        self.output_limiter = DynamicsProcessor.limiter(sample_rate=self.sample_rate)
+        
+        # Block size / latency tuning and stream renegotiation
+        self.tuner = LatencyAutoTuner(self.sample_rate)
+        self.stream_latency = None
+        
+        # Duplex stream on Config.AUDIO_DEVICE; start/stop/renegotiate hold the lock
+        self.device = Config.AUDIO_DEVICE
+        self._lifecycle = threading.Lock()
+        # Callback metrics describe the sound card stream only, not offline renders
+        self._live = False
+        
+        # Voice activity gate: skips the chain on silence
+        self.gate = VoiceActivityGate(sample_rate=self.sample_rate) if Config.GATE_ENABLED else None
+        
+        # Extra outputs (pipes, virtual devices, async streams)
+        self.sink_ring = PCMRing(Config.SINK_QUEUE_BLOCKS, Config.SINK_MAX_BLOCK, self.channels)
+        self.sinks = []
+    
+    def register_metrics(self):
+        """Expose this (live) engine's state on the metrics registry"""
+        metrics.gauge("voice_block_size", "Current stream block size",
+                      fn=lambda: self.buffer_size)
+        metrics.gauge("voice_callback_load", "p99 callback time / block period (last tuner window)",
+                      fn=lambda: self.tuner.load)
+        metrics.gauge("voice_sink_backlog_blocks", "Largest sink backlog",
+                      fn=lambda: max((sink.reader.backlog for sink in self.sinks), default=0))
+        metrics.counter("voice_sink_dropped_total", "Blocks dropped by lagging sinks",
+                        fn=lambda: sum(sink.dropped for sink in self.sinks))
+        metrics.counter("voice_chain_cache_hits_total", "Compiled chain coefficient cache hits",
+                        fn=lambda: self.compiler.cache_hits)
+        metrics.counter("voice_chain_cache_misses_total", "Compiled chain coefficient cache misses",
+                        fn=lambda: self.compiler.cache_misses)
+        metrics.gauge("voice_loudness_momentary_lufs", "Momentary loudness before makeup gain",
+                      fn=lambda: max(self.normalizer.meter.momentary, -70.0))
+        metrics.gauge("voice_loudness_short_term_lufs", "Short-term loudness before makeup gain",
+                      fn=lambda: max(self.normalizer.meter.short_term, -70.0))
+        metrics.gauge("voice_makeup_gain_db", "Current loudness makeup gain",
+                      fn=lambda: self.normalizer.gain_db)
+        
+    @property
+    def characters(self):
+        """Currently loaded character definitions"""
+        return self.library.characters
+    
+    def get_chain(self, character):
+        """Get (or compile) the processing chain for a character"""
+        chain = self.chains.get(character)
+        if chain is None:
+            chain = self.compiler.compile(self.library.characters[character])
+            self.chains[character] = chain
+        return chain
+    
+    def reload_characters(self, keys=None):
+        """Re-read character files and replace chains whose definition changed
+
+        Replacement chains are compiled before taking the processing lock,
+        so the audio thread never compiles (disk cache, warp matrices).
+        """
+        if keys is None:
+            keys = self.library.reload()
+        characters = self.library.characters
+        fresh = {key: self.compiler.compile(characters[key])
+                 for key in keys if key in self.chains and key in characters}
+        with self.processing_lock:
+            self.chains = {key: chain for key, chain in self.chains.items()
+                           if key not in keys}
+            self.chains.update(fresh)
+            if self.current_character not in ["normal"] + list(self.library.characters):
+                self.current_character = "normal"
+        return keys
+    
+    def add_sink(self, sink):
+        """Start an output sink and feed it from the audio callback"""
+        sink.start()
+        self.sinks = self.sinks + [sink]
+        return sink
+    
+    def remove_sinks(self, kind=None):
+        """Stop and detach sinks (all, or only those of one kind)"""
+        removed = [sink for sink in self.sinks if kind is None or sink.kind == kind]
+        self.sinks = [sink for sink in self.sinks if sink not in removed]
+        for sink in removed:
+            sink.stop()
+        return removed
+    
+    def open_async_sink(self, loop):
+        """Attach an in-memory stream that an asyncio consumer can iterate"""
+        return self.add_sink(AsyncStreamSink(self.sink_ring, loop))
+    
+    def apply_character_voice(self, audio_data, character):
+        """Apply specific character voice transformation"""
+        if character == "normal" or character not in self.library.characters:
+            return audio_data
+        
+        try:
+            return self.get_chain(character).process(audio_data)
+            
+        except Exception as e:
+            logging.error(f"Character voice processing error: {e}")
+            return audio_data
+    
+    def audio_callback(self, indata, outdata, frames, time_info, status):
+        """Real-time audio processing callback"""
+        started = time.perf_counter()
+        if status:
+            logging.warning(f"Audio status: {status}")
+        
+        try:
+            with self.processing_lock:
+                if self.channel_mode == "stereo":
+                    # Process the (frames, channels) block as-is
+                    block = indata
+                elif indata.shape[1] > 1:
+                    # Downmix once, process mono
+                    block = indata.mean(axis=1)
+                else:
+                    block = indata[:, 0]
+                
+                chain = self.chains.get(self.current_character)
+                pending = chain.pending if chain is not None else 0
+                if self.gate is not None and not self.gate.update(block, pending):
+                    # Silence: skip the chain, let its state decay
+                    if self._live:
+                        GATED_BLOCKS_TOTAL.inc()
+                    outdata.fill(0)
+                    self.gate.idle(chain, frames)
+                    self.normalizer.advance(frames)
+                else:
+                    # Apply character voice transformation
+                    processed = self.apply_character_voice(block, self.current_character)
+                    
+                    # Same loudness for every character
+                    spec = self.library.characters.get(self.current_character)
+                    if spec is not None:
+                        processed = self.normalizer.process(processed,
+                                                            spec.get("target_lufs", Config.TARGET_LUFS))
+                    
+                    # Prevent clipping
+                    processed = self.output_limiter.process(processed)
+                    
+                    if self.gate is not None:
+                        processed = self.gate.apply(processed)
+                    
+                    # Output (a mono result is broadcast to every channel)
+                    if processed.ndim == 1:
+                        outdata[:] = processed[:, None]
+                    else:
+                        outdata[:] = processed
+                
+                # Hand the block to the extra sinks without blocking
+                if self.sinks:
+                    self.sink_ring.write(outdata)
+                    for sink in self.sinks:
+                        sink.notify()
+                
+        except Exception as e:
+            logging.error(f"Audio callback error: {e}")
+            outdata[:] = indata  # Fallback to original
+        
+        elapsed = time.perf_counter() - started
+        self.tuner.observe(elapsed, status)
+        if self._live:
+            CALLBACK_SECONDS.observe(elapsed)
+            BLOCKS_TOTAL.inc()
+            if status and (status.input_overflow or status.output_underflow):
+                XRUNS_TOTAL.inc()
+    
+    def tune_blocksize(self, character):
+        """Benchmark the character chain and pick block size / latency"""
+        if not Config.AUTO_TUNE:
+            return self.buffer_size
+        
+        spec = self.library.characters.get(character)
+        key = self.compiler.plan_hash(self.compiler.plan(spec)) if spec else "normal"
+        channels = (self.channels,) if self.channel_mode == "stereo" else ()
+        
+        def make_processor():
+            chain = self.compiler.compile(spec) if spec else None
+            normalizer = LoudnessNormalizer(self.sample_rate)
+            limiter = DynamicsProcessor.limiter(sample_rate=self.sample_rate)
+            
+            def process(block):
+                if chain is not None:
+                    block = normalizer.process(chain.process(block))
+                return limiter.process(block)
+            return process
+        
+        self.buffer_size = self.tuner.benchmark(make_processor, key, channels)
+        self.stream_latency = self.tuner.latency
+        return self.buffer_size
+    
+    def renegotiate(self):
+        """Reopen the stream with the tuner's current block size and latency"""
+        with self._lifecycle:
+            self.buffer_size = self.tuner.blocksize
+            self.stream_latency = self.tuner.latency
+            if self.is_active:
+                self._open_stream()
+    
+    def _open_stream(self):
+        # One duplex stream: input and output share a callback and a clock
+        self._live = True
+        audio_streams.open(self.device, lambda: sd.Stream(device=self.device,
+                                                          callback=self.audio_callback,
+                                                          channels=self.channels,
+                                                          samplerate=self.sample_rate,
+                                                          blocksize=self.buffer_size,
+                                                          latency=self.stream_latency))
+    
+    def start_voice_clone(self, character="normal"):
+        """Start real-time voice cloning; returns True once the stream is running"""
+        if sd is None:
+            logging.error("Voice clone start error: sounddevice/PortAudio not available")
+            return False
+        
+        with self._lifecycle:
+            try:
+                # Compile the chain up front instead of inside the first callback
+                if character in self.library.characters:
+                    self.get_chain(character)
+                
+                self.tune_blocksize(character)
+                self.current_character = character
+                
+                started = time.perf_counter()
+                self._open_stream()
+                self.is_active = True
+                logging.info(f"Voice clone started with character: {character} "
+                             f"(block {self.buffer_size}, opened in "
+                             f"{(time.perf_counter() - started) * 1000:.1f} ms)")
+            except Exception as e:
+                logging.error(f"Voice clone start error: {e}")
+                audio_streams.close(self.device)
+                self.is_active = False
+                return False
+        
+        if Config.AUTO_TUNE:
+            self.tuner.start(self.renegotiate)
+        return True
+            
+    def stop_voice_clone(self):
+        """Stop voice cloning; returns once the stream is closed"""
+        started = time.perf_counter()
+        with self._lifecycle:
+            self.is_active = False
+            audio_streams.close(self.device)
+        # Outside the lock: the tuner thread may be waiting for it in renegotiate()
+        self.tuner.stop()
+        logging.info(f"Voice clone stopped ({(time.perf_counter() - started) * 1000:.1f} ms)")
+    
+    async def start(self, character="normal"):
+        """Awaitable ``start_voice_clone`` (runs on the executor)"""
+        return await asyncio.get_running_loop().run_in_executor(None, self.start_voice_clone, character)
+    
+    async def stop(self):
+        """Awaitable ``stop_voice_clone``"""
+        await asyncio.get_running_loop().run_in_executor(None, self.stop_voice_clone)
+
+# ================================
+# SIMULATED AUDIO BACKEND
+# ================================
+
+SimulatedTime = namedtuple("SimulatedTime", "inputBufferAdcTime outputBufferDacTime currentTime")
+
+
+class SimulatedCallbackFlags:
+    """Stand-in for ``sounddevice.CallbackFlags``"""
+
+    FLAGS = ("input_underflow", "input_overflow", "output_underflow",
+             "output_overflow", "priming_output")
+
+    def __init__(self, **flags):
+        for flag in self.FLAGS:
+            setattr(self, flag, bool(flags.get(flag, False)))
+
+    def __bool__(self):
+        return any(getattr(self, flag) for flag in self.FLAGS)
+
+    def __str__(self):
+        return ", ".join(flag.replace("_", " ") for flag in self.FLAGS if getattr(self, flag))
+
+
+def load_audio(source):
+    """Load a WAV file (memory-mapped), raw ``.f32`` file or array as float32 (frames, channels)"""
+    if isinstance(source, np.ndarray):
+        audio = source
+    else:
+        path = Path(source)
+        if path.suffix == SampleLibrary.SUFFIX:
+            audio = np.memmap(path, dtype=np.float32, mode="r")
+        else:
+            _, audio = wavfile.read(path, mmap=True)
+    
+    if audio.dtype.kind in "iu":
+        scale = float(np.iinfo(audio.dtype).max) + 1
+        if audio.dtype.kind == "u":
+            audio = (audio.astype(np.float32) - scale / 2) / (scale / 2)
+        else:
+            audio = audio.astype(np.float32) / scale
+    audio = np.asarray(audio, dtype=np.float32)
+    return audio.reshape(len(audio), -1)
+
+
+def save_audio(path, audio, sample_rate=Config.SAMPLE_RATE):
+    """Write float32 audio as a WAV file"""
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    wavfile.write(path, sample_rate, np.asarray(audio, dtype=np.float32))
+
+
+def compare_audio(output, golden, tolerance=1e-4):
+    """Compare a render against a golden render"""
+    output = np.asarray(output, dtype=np.float64)
+    golden = np.asarray(golden, dtype=np.float64)
+    if output.shape != golden.shape:
+        return {"passed": False, "reason": f"shape {output.shape} != {golden.shape}"}
+    
+    error = output - golden
+    max_error = float(np.max(np.abs(error))) if error.size else 0.0
+    noise = float(np.sum(error ** 2))
+    signal = float(np.sum(golden ** 2))
+    snr_db = 10 * np.log10(signal / noise) if noise > 0 else float("inf")
+    return {"passed": max_error <= tolerance, "max_error": max_error, "snr_db": snr_db}
+
+
+class SimulatedAudioBackend:
+    """Drives an audio callback from recorded audio instead of a sound card
+
+    The callback is called with the exact ``sounddevice.Stream`` signature
+    ``(indata, outdata, frames, time, status)``. Callback overruns (its own
+    duration plus simulated scheduling jitter beyond the block period) are
+    reported to the next callback as underflow/overflow flags, like
+    PortAudio does.
+    """
+
+    def __init__(self, callback, sample_rate=Config.SAMPLE_RATE, blocksize=Config.BUFFER_SIZE,
+                 channels=1, jitter_ms=0.0, realtime=False, seed=0):
+        self.callback = callback
+        self.sample_rate = sample_rate
+        self.blocksize = blocksize
+        self.channels = channels
+        self.jitter = jitter_ms / 1000
+        self.realtime = realtime
+        self.rng = np.random.default_rng(seed)
+        self.durations = []
+        self.xruns = 0
+
+    @property
+    def period(self):
+        """Block period in seconds"""
+        return self.blocksize / self.sample_rate
+
+    def stats(self):
+        """Callback timing summary"""
+        if not self.durations:
+            return {}
+        durations = np.array(self.durations)
+        return {
+            "blocks": len(durations),
+            "mean_ms": float(durations.mean() * 1000),
+            "p99_ms": float(np.percentile(durations, 99) * 1000),
+            "max_ms": float(durations.max() * 1000),
+            "load": float(durations.mean() / self.period),
+            "xruns": self.xruns,
+        }
+
+    def run(self, source):
+        """Play ``source`` through the callback and return the captured output"""
+        audio = load_audio(source)
+        if audio.shape[1] < self.channels:
+            audio = np.repeat(audio[:, :1], self.channels, axis=1)
+        audio = audio[:, :self.channels]
+        
+        total = len(audio)
+        output = np.zeros((total, self.channels), dtype=np.float32)
+        indata = np.zeros((self.blocksize, self.channels), dtype=np.float32)
+        outdata = np.zeros((self.blocksize, self.channels), dtype=np.float32)
+        status = SimulatedCallbackFlags()
+        clock = 0.0
+        
+        for start in range(0, total, self.blocksize):
+            count = min(self.blocksize, total - start)
+            indata[:count] = audio[start:start + count]
+            indata[count:] = 0.0
+            outdata[:] = 0.0
+            
+            delay = abs(self.rng.normal(0.0, self.jitter)) if self.jitter else 0.0
+            stamp = SimulatedTime(clock, clock + 2 * self.period, clock + self.period + delay)
+            
+            began = time.perf_counter()
+            self.callback(indata, outdata, self.blocksize, stamp, status)
+            elapsed = time.perf_counter() - began
+            self.durations.append(elapsed)
+            
+            output[start:start + count] = outdata[:count]
+            
+            overrun = elapsed + delay > self.period
+            self.xruns += overrun
+            status = SimulatedCallbackFlags(input_overflow=overrun, output_underflow=overrun)
+            clock += self.period
+            
+            if self.realtime:
+                time.sleep(max(0.0, self.period - elapsed))
+        
+        return output
+
+
+def prestretch(source, chain):
+    """Apply a chain's speaking rate to a whole recording and bypass its live stage"""
+    stage = chain.find_stage(TimeStretchStage)
+    if stage is None:
+        return source
+    stage.bypass = True
+    return stage.stretch(load_audio(source))
+
+
+def render_character(source, character, blocksize=Config.BUFFER_SIZE, jitter_ms=0.0,
+                     channels=Config.CHANNELS, channel_mode=Config.CHANNEL_MODE, stretch=False,
+                     profile=None, flush=False, library=None):
+    """Render ``source`` through a fresh engine; returns (output, timing stats)
+
+    With ``stretch`` the speaking rate changes the duration (offline
+    conversion) instead of running through the live elastic buffer. A
+    VoiceProfile levels the input and aims pitch/formant at the
+    character's targets. With ``flush`` the processing latency is removed
+    and the chain's tail (reverb, overlap) is played out after the input,
+    as a finished recording needs; without it the output lines up with
+    the live stream (replay and golden renders). Pass the bot's
+    ``library`` to avoid re-reading the character directory.
+    """
+    engine = VoiceCloneEngine(channels=channels, channel_mode=channel_mode, library=library)
+    chain = None
+    if profile is not None:
+        source = load_audio(source) * np.float32(profile.input_gain)
+    if character != "normal":
+        spec = engine.library.characters[character]
+        if profile is not None:
+            # Adapted shifts change with every recording while a profile learns;
+            # keep them out of the disk cache
+            engine.chains[character] = engine.compiler.compile(profile.adapt(spec), cache=False)
+        chain = engine.get_chain(character)
+        if stretch:
+            source = prestretch(source, chain)
+    engine.current_character = character
+    
+    callback, latency = engine.audio_callback, 0
+    if flush:
+        source = load_audio(source)
+        latency = engine.output_limiter.latency + (chain.latency if chain is not None else 0)
+        padding = engine.output_limiter.latency + (chain.tail if chain is not None else 0)
+        source = np.concatenate([source, np.zeros((padding,) + source.shape[1:], dtype=source.dtype)])
+        end, played = len(source) - padding, 0
+        
+        def callback(indata, outdata, frames, time_info, status):
+            # Keep an open gate open until the padding has played the tail out
+            nonlocal played
+            engine.audio_callback(indata, outdata, frames, time_info, status)
+            if engine.gate is not None and played < end <= played + frames:
+                engine.gate.hold(padding)
+            played += frames
+    
+    backend = SimulatedAudioBackend(callback, sample_rate=engine.sample_rate,
+                                    blocksize=blocksize, channels=channels, jitter_ms=jitter_ms)
+    return backend.run(source)[latency:], backend.stats()
+
+
+def run_regression(source, golden_dir, characters=None, update=False, tolerance=1e-4,
+                   blocksize=Config.BUFFER_SIZE):
+    """Render every character and compare with (or record) golden renders"""
+    golden_dir = Path(golden_dir)
+    library = CharacterLibrary(Config.CHARACTERS_DIR)
+    if characters is None:
+        characters = ["normal"] + list(library.characters)
+    
+    results = {}
+    for character in characters:
+        output, stats = render_character(source, character, blocksize=blocksize, library=library)
+        golden_path = golden_dir / f"{character}.wav"
+        
+        if update or not golden_path.exists():
+            save_audio(golden_path, output)
+            result = {"passed": True, "recorded": True}
+        else:
+            result = compare_audio(output, load_audio(golden_path), tolerance)
+        result.update(stats)
+        results[character] = result
+    return results
+
+
+def check_builtin_samples(characters=None, timeout=60.0):
+    """Render convolution characters with an empty samples directory
+
+    Built-in impulse responses are synthesized and written on first use;
+    this exercises that path (a fresh deploy) without touching the real
+    SAMPLES_DIR. Returns {character: error message or None}.
+    """
+    global sample_library
+    if characters is None:
+        characters = [key for key, spec in Config.VOICE_CHARACTERS.items()
+                      if any(stage["type"] == "convolution" for stage in spec.get("stages", []))]
+    source = np.zeros((Config.SAMPLE_RATE // 2, 1), dtype=np.float32)
+    source[0] = 0.5
+    
+    results = {}
+    shared = sample_library
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            sample_library = SampleLibrary(directory)
+            for character in characters:
+                outcome = {}
+                
+                def render():
+                    try:
+                        output, _ = render_character(source, character)
+                        outcome["error"] = None if np.any(output) else "silent output"
+                    except Exception as e:
+                        outcome["error"] = str(e)
+                
+                worker = threading.Thread(target=render, daemon=True)
+                worker.start()
+                worker.join(timeout)
+                results[character] = outcome.get("error", f"no result after {timeout:.0f} s")
+                if worker.is_alive():
+                    break
+    finally:
+        sample_library = shared
+    return results
+
+# ================================
+# PARALLEL RENDERING
+# ================================
+
+def _render_segment(job):
+    """Process-pool worker: render one segment from shared input into shared output"""
+    source_shm = shared_memory.SharedMemory(name=job["source"])
+    output_shm = shared_memory.SharedMemory(name=job["output"])
+    try:
+        source = np.ndarray(job["source_shape"], dtype=np.float32, buffer=source_shm.buf)
+        outputs = np.ndarray(job["output_shape"], dtype=np.float32, buffer=output_shm.buf)
+        
+        # The parent's definition, so workers do not scan the character directory
+        library = CharacterLibrary(None)
+        if job["spec"] is not None:
+            library.characters[job["character"]] = job["spec"]
+        engine = VoiceCloneEngine(channels=job["channels"], channel_mode=job["channel_mode"],
+                                  library=library)
+        if job["character"] != "normal":
+            chain = engine.get_chain(job["character"])
+            # The parent already applied the speaking rate
+            stage = chain.find_stage(TimeStretchStage)
+            if stage is not None:
+                stage.bypass = True
+            chain.seek(job["render_start"])
+        engine.current_character = job["character"]
+        engine.normalizer.seek(job["render_start"])
+        
+        backend = SimulatedAudioBackend(engine.audio_callback, sample_rate=engine.sample_rate,
+                                        blocksize=job["blocksize"], channels=job["channels"])
+        rendered = backend.run(source[job["render_start"]:job["stop"]])
+        
+        # Drop the pre-roll, then fade in/out over the overlaps with the neighbours
+        start, stop, fade = job["start"], job["stop"], job["fade"]
+        segment = rendered[start - job["render_start"]:]
+        ramp = ((np.arange(fade) + 0.5) / fade).astype(np.float32)[:, None]
+        if job["fade_in"]:
+            segment[:fade] *= ramp
+        if job["fade_out"]:
+            segment[-fade:] *= 1.0 - ramp
+        outputs[job["index"] % 2, start:stop] = segment
+        return backend.stats()
+    finally:
+        source_shm.close()
+        output_shm.close()
+
+
+class ParallelRenderer:
+    """Renders long recordings as overlapping segments across a process pool
+
+    Segment boundaries sit on the block grid so every worker sees the same
+    block framing as a sequential render. Each worker starts ``preroll``
+    samples early to let filter, envelope and reverb state settle, and
+    neighbouring segments are crossfaded over ``crossfade`` samples. Even
+    and odd segments are written to separate shared-memory planes so no two
+    workers touch the same samples; the planes are summed at the end.
+    The speaking rate is applied to the whole input up front, since the
+    live elastic buffer depends on everything that came before.
+    """
+
+    def __init__(self, workers=None, blocksize=Config.BUFFER_SIZE,
+                 segment_seconds=Config.PARALLEL_SEGMENT_SECONDS,
+                 preroll_seconds=Config.PARALLEL_PREROLL_SECONDS,
+                 crossfade_seconds=Config.PARALLEL_CROSSFADE_SECONDS,
+                 sample_rate=Config.SAMPLE_RATE, library=None):
+        self.library = library or CharacterLibrary(Config.CHARACTERS_DIR)
+        self.workers = workers or os.cpu_count() or 1
+        self.blocksize = blocksize
+        self.sample_rate = sample_rate
+        self.segment_seconds = segment_seconds
+        self.preroll_seconds = preroll_seconds
+        self.crossfade_seconds = crossfade_seconds
+
+    def _compile(self, character):
+        return self.library.compiler.compile(self.library.characters[character])
+
+    def _blocks(self, seconds, minimum=1):
+        """Duration rounded up to whole blocks, in samples"""
+        return max(minimum, int(np.ceil(seconds * self.sample_rate / self.blocksize))) * self.blocksize
+
+    def plan(self, total, character="normal"):
+        """Segment layout: list of (render_start, start, stop) plus the crossfade length"""
+        preroll = self._blocks(self.preroll_seconds)
+        if character != "normal":
+            chain = self._compile(character)
+            # The makeup gain follows the last short-term window of settled chain output
+            window = (LoudnessMeter.SHORT_TERM_BUCKETS + 2) * LoudnessMeter.BUCKET_SECONDS
+            preroll = max(preroll, self._blocks(chain.tail / self.sample_rate + window))
+        fade = self._blocks(self.crossfade_seconds)
+        
+        # Enough segments to keep every worker busy, but never shorter than two fades
+        segment = min(self._blocks(self.segment_seconds),
+                      self._blocks(total / self.sample_rate / self.workers))
+        segment = max(segment, 2 * fade)
+        
+        # A remainder no longer than the fade is folded into the previous segment
+        starts = list(range(0, total, segment))
+        if len(starts) > 1 and total - starts[-1] <= fade:
+            starts.pop()
+        
+        segments = []
+        for start in starts:
+            stop = min(total, start + segment + fade)
+            segments.append((max(0, start - preroll), start, stop))
+        return segments, fade
+
+    def render(self, source, character, channels=Config.CHANNELS, channel_mode=Config.CHANNEL_MODE):
+        """Render ``source`` through ``character``; returns (output, stats)"""
+        audio = load_audio(source)
+        if character != "normal":
+            audio = load_audio(prestretch(audio, self._compile(character)))
+        if audio.shape[1] < channels:
+            audio = np.repeat(audio[:, :1], channels, axis=1)
+        audio = np.ascontiguousarray(audio[:, :channels], dtype=np.float32)
+        total = len(audio)
+        segments, fade = self.plan(total, character)
+        
+        began = time.perf_counter()
+        source_shm = shared_memory.SharedMemory(create=True, size=max(1, audio.nbytes))
+        output_shape = (2, total, channels)
+        output_shm = shared_memory.SharedMemory(create=True, size=max(1, 4 * int(np.prod(output_shape))))
+        try:
+            shared = np.ndarray(audio.shape, dtype=np.float32, buffer=source_shm.buf)
+            shared[:] = audio
+            planes = np.ndarray(output_shape, dtype=np.float32, buffer=output_shm.buf)
+            planes[:] = 0.0
+            
+            jobs = [{
+                "index": index, "character": character,
+                "source": source_shm.name, "source_shape": audio.shape,
+                "output": output_shm.name, "output_shape": output_shape,
+                "render_start": render_start, "start": start, "stop": stop,
+                "fade": fade, "fade_in": index > 0, "fade_out": index < len(segments) - 1,
+                "blocksize": self.blocksize, "channels": channels, "channel_mode": channel_mode,
+                "spec": self.library.characters.get(character),
+            } for index, (render_start, start, stop) in enumerate(segments)]
+            
+            if len(jobs) == 1 or self.workers == 1:
+                # Not worth starting a pool
+                worker_stats = [_render_segment(job) for job in jobs]
+            else:
+                # spawn: the bot process runs threads, which fork() would copy in a broken state
+                context = multiprocessing.get_context("spawn")
+                with ProcessPoolExecutor(max_workers=min(self.workers, len(jobs)),
+                                         mp_context=context) as pool:
+                    worker_stats = list(pool.map(_render_segment, jobs))
+            
+            output = planes.sum(axis=0)
+        finally:
+            source_shm.close()
+            source_shm.unlink()
+            output_shm.close()
+            output_shm.unlink()
+        
+        elapsed = time.perf_counter() - began
+        rendered = sum(stop - render_start for render_start, _, stop in segments)
+        stats = {
+            "segments": len(segments),
+            "workers": min(self.workers, len(segments)),
+            "seconds": elapsed,
+            "speed": total / self.sample_rate / elapsed if elapsed else 0.0,
+            "overhead": rendered / total - 1.0 if total else 0.0,
+            "mean_ms": float(np.mean([s.get("mean_ms", 0.0) for s in worker_stats])) if worker_stats else 0.0,
         }
-    }
+        return output, stats
+
+
+def check_parallel(source, characters, tolerance=1e-4, blocksize=Config.BUFFER_SIZE):
+    """Compare segmented renders with sequential ones for awkward segment layouts
+
+    For each character the input is cut into one full segment plus a
+    remainder that is shorter than a block, just under one crossfade and
+    just over one crossfade, so the last segment never ends on the block
+    grid. Segments are rendered in-process; the pool only changes where
+    they run.
+    """
+    library = CharacterLibrary(Config.CHARACTERS_DIR)
+    results = {}
+    for character in characters:
+        reference, _ = render_character(source, character, blocksize=blocksize, stretch=True,
+                                        library=library)
+        total = len(reference)
+        fade = ParallelRenderer(blocksize=blocksize, library=library).plan(total)[1]
+        tail = total % blocksize or blocksize
+        
+        checks = {}
+        for remainder in (tail, tail + fade - blocksize, tail + fade):
+            segment = total - remainder
+            if segment < 2 * fade:
+                continue
+            renderer = ParallelRenderer(workers=1, blocksize=blocksize, library=library,
+                                        segment_seconds=(segment - 0.5) / Config.SAMPLE_RATE)
+            output, _ = renderer.render(source, character)
+            checks[remainder] = compare_audio(output, reference, tolerance)
+        results[character] = checks
+    return results
 
 # ================================
-# VOICE PROCESSING ENGINE
+# VOICE PROFILES
 # ================================
 
-class VoiceCloneEngine:
-    def __init__(self):
-        self.is_active = False
-        self.current_character = "normal"
-        self.audio_thread = None
-        self.input_stream = None
-        self.output_stream = None
-        self.processing_lock = threading.Lock()
+class VoiceProfile:
+    """Summary of one user's voice: median F0, mean spectral envelope, loudness"""
+
+    def __init__(self, record, f0_edges, band_edges, seconds_per_frame):
+        self.seconds = float(record["voiced"]) * seconds_per_frame
+        self.loudness_db = float(record["loudness"] / record["frames"]) if record["frames"] else None
         
-        # Audio processing parameters
-        self.sample_rate = Config.SAMPLE_RATE
-        self.buffer_size = Config.BUFFER_SIZE
+        histogram = record["f0_hist"].astype(float)
+        if histogram.sum() > 0:
+            # Geometric centre of the bin holding the median
+            index = int(np.searchsorted(np.cumsum(histogram), histogram.sum() / 2))
+            self.median_f0 = float(np.sqrt(f0_edges[index] * f0_edges[index + 1]))
+        else:
+            self.median_f0 = None
         
-        # Voice modification buffers
-        self.audio_buffer = np.zeros(self.buffer_size * 4)
-        self.buffer_index = 0
+        if record["voiced"]:
+            self.envelope = record["envelope"] / record["voiced"]
+            centres = np.sqrt(band_edges[:-1] * band_edges[1:])
+            power = 10 ** (self.envelope / 10)
+            self.centroid = float(np.sum(centres * power) / np.sum(power))
+        else:
+            self.envelope = None
+            self.centroid = None
         
-    def apply_character_voice(self, audio_data, character):
-        """Apply specific character voice transformation"""
-        if character == "normal" or character not in Config.VOICE_CHARACTERS:
-            return audio_data
-            
-        char_config = Config.VOICE_CHARACTERS[character]
-        processed = audio_data.copy()
+        self.ready = self.seconds >= Config.VOICE_PROFILE_MIN_SECONDS and self.median_f0 is not None
+
+    @property
+    def input_gain(self):
+        """Gain that brings this voice to VOICE_PROFILE_TARGET_DB"""
+        if self.loudness_db is None:
+            return 1.0
+        return float(np.clip(10 ** ((Config.VOICE_PROFILE_TARGET_DB - self.loudness_db) / 20), 0.25, 4.0))
+
+    def adapt(self, spec):
+        """Character definition with pitch/formant shifts aimed at its targets for this voice"""
+        if not self.ready:
+            return spec
+        adapted = dict(spec)
+        if "target_f0" in spec:
+            adapted["pitch_factor"] = round(float(np.clip(spec["target_f0"] / self.median_f0, 0.25, 4.0)), 3)
+        if "target_centroid" in spec and self.centroid:
+            adapted["formant_shift"] = round(float(np.clip(spec["target_centroid"] / self.centroid, 0.5, 2.0)), 3)
+        return adapted
+
+
+class VoiceProfileStore:
+    """Per-user voice statistics in one memory-mapped file of fixed-size records
+
+    Each record holds running sums (F0 histogram counts, summed band
+    log-powers, summed frame levels), so a new recording is folded in
+    without keeping the old ones. Once a profile has ``VOICE_PROFILE_MAX_SECONDS``
+    of voiced audio, analysis is skipped altogether.
+    """
+
+    FRAME_SIZE = 2048
+    HOP_SIZE = 1024
+    F0_EDGES = np.geomspace(50.0, 800.0, 49)
+    BAND_EDGES = np.geomspace(100.0, 8000.0, 33)
+    DTYPE = np.dtype([
+        ("user", "<i8"),
+        ("frames", "<f8"),
+        ("voiced", "<f8"),
+        ("loudness", "<f8"),
+        ("f0_hist", "<f4", (48,)),
+        ("envelope", "<f8", (32,)),
+    ])
+
+    def __init__(self, path=Config.VOICE_PROFILES_PATH, sample_rate=Config.SAMPLE_RATE, capacity=64):
+        self.path = Path(path)
+        self.sample_rate = sample_rate
+        self.capacity = capacity
+        self._records = None
+        self._index = {}
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._records is not None:
+            return
+        if not self.path.exists():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            np.zeros(self.capacity, dtype=self.DTYPE).tofile(self.path)
+        self._records = np.memmap(self.path, dtype=self.DTYPE, mode="r+")
+        self._index = {int(user): row for row, user in enumerate(self._records["user"]) if user}
+
+    def _allocate(self, user):
+        free = np.flatnonzero(self._records["user"] == 0)
+        if not len(free):
+            # Double the file; existing rows keep their positions
+            size = len(self._records)
+            self._records.flush()
+            self._records = None
+            with open(self.path, "ab") as f:
+                np.zeros(size, dtype=self.DTYPE).tofile(f)
+            self._records = np.memmap(self.path, dtype=self.DTYPE, mode="r+")
+            free = [size]
+        row = int(free[0])
+        self._records[row] = np.zeros((), dtype=self.DTYPE)
+        self._records["user"][row] = user
+        self._index[user] = row
+        return row
+
+    def _profile(self, row):
+        return VoiceProfile(self._records[row], self.F0_EDGES, self.BAND_EDGES,
+                            self.HOP_SIZE / self.sample_rate)
+
+    def get(self, user):
+        """VoiceProfile for ``user``, or None"""
+        with self._lock:
+            self._open()
+            row = self._index.get(user)
+            return None if row is None else self._profile(row)
+
+    def analyze(self, audio):
+        """Per-frame levels, F0 of voiced frames and band log-powers of voiced frames"""
+        audio = np.asarray(audio, dtype=float)
+        mono = audio.mean(axis=1) if audio.ndim > 1 else audio
+        if len(mono) < self.FRAME_SIZE:
+            return np.zeros(0), np.zeros(0), np.zeros((0, len(self.BAND_EDGES) - 1))
+        frames = sliding_window_view(mono, self.FRAME_SIZE)[::self.HOP_SIZE]
+        levels = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-12)
         
-        try:
-            # Pitch modification
-            if char_config["pitch_factor"] != 1.0:
-                processed = self.pitch_shift(processed, char_config["pitch_factor"])
-            
-            # Formant shifting for voice character
-            if char_config["formant_shift"] != 1.0:
-                processed = self.formant_shift(processed, char_config["formant_shift"])
-            
-            # Apply tone profile specific effects
-            tone = char_config["tone_profile"]
-            if tone == "nasal":
-                processed = self.apply_nasal_effect(processed)
-            elif tone == "excited":
-                processed = self.apply_excitement_effect(processed)
-            elif tone == "authoritative":
-                processed = self.apply_authority_effect(processed)
-            elif tone == "friendly":
-                processed = self.apply_warmth_effect(processed)
-            elif tone == "energetic":
-                processed = self.apply_energy_effect(processed)
+        windowed = frames * np.hanning(self.FRAME_SIZE)
+        spectrum = np.abs(np.fft.rfft(windowed, n=2 * self.FRAME_SIZE, axis=1)) ** 2
+        # Autocorrelation pitch: strongest lag between 800 Hz and 60 Hz
+        autocorr = np.fft.irfft(spectrum, axis=1)[:, :self.FRAME_SIZE]
+        low, high = self.sample_rate // 800, self.sample_rate // 60
+        lags = low + np.argmax(autocorr[:, low:high], axis=1)
+        strength = autocorr[np.arange(len(lags)), lags] / (autocorr[:, 0] + 1e-12)
+        voiced = (levels > Config.GATE_OPEN_DB) & (strength > 0.4)
+        
+        freqs = np.fft.rfftfreq(2 * self.FRAME_SIZE, 1 / self.sample_rate)
+        band = np.digitize(freqs, self.BAND_EDGES) - 1
+        inside = (band >= 0) & (band < len(self.BAND_EDGES) - 1)
+        powers = np.zeros((int(voiced.sum()), len(self.BAND_EDGES) - 1))
+        np.add.at(powers.T, band[inside], spectrum[voiced][:, inside].T)
+        bands = 10 * np.log10(powers + 1e-12)
+        return levels[levels > Config.GATE_OPEN_DB], self.sample_rate / lags[voiced], bands
+
+    def update(self, user, audio):
+        """Fold a recording into ``user``'s profile (no-op once it is complete)"""
+        with self._lock:
+            self._open()
+            row = self._index.get(user)
+            if row is not None and self._profile(row).seconds >= Config.VOICE_PROFILE_MAX_SECONDS:
+                return self._profile(row)
+        
+        levels, f0, bands = self.analyze(audio)
+        
+        with self._lock:
+            row = self._index.get(user)
+            if row is None:
+                row = self._allocate(user)
+            record = self._records[row:row + 1]
+            record["frames"] += len(levels)
+            record["loudness"] += levels.sum()
+            record["voiced"] += len(f0)
+            record["f0_hist"] += np.histogram(f0, bins=self.F0_EDGES)[0].astype(np.float32)
+            record["envelope"] += bands.sum(axis=0)
+            self._records.flush()
+            return self._profile(row)
+
+    def reset(self, user):
+        """Forget a user's profile"""
+        with self._lock:
+            self._open()
+            row = self._index.pop(user, None)
+            if row is not None:
+                self._records[row] = np.zeros((), dtype=self.DTYPE)
+                self._records.flush()
+
+
+voice_profiles = VoiceProfileStore(Config.VOICE_PROFILES_PATH)
+
+# ================================
+# MEDIA PIPELINE
+# ================================
+
+def decode_audio(source, sample_rate=Config.SAMPLE_RATE):
+    """Decode anything ffmpeg reads (bytes or a file path) to float32 mono (frames, 1)"""
+    from_bytes = isinstance(source, (bytes, bytearray))
+    command = ["ffmpeg", "-v", "error", "-i", "pipe:0" if from_bytes else str(source),
+               "-f", "f32le", "-ac", "1", "-ar", str(sample_rate), "pipe:1"]
+    result = subprocess.run(command, input=source if from_bytes else None,
+                            capture_output=True, check=True)
+    return np.frombuffer(result.stdout, dtype=np.float32).reshape(-1, 1)
+
+
+def encode_voice(audio, sample_rate=Config.SAMPLE_RATE):
+    """Encode float32 (frames, channels) audio as an OGG/Opus voice note"""
+    audio = np.ascontiguousarray(np.clip(audio, -1.0, 1.0), dtype=np.float32)
+    command = ["ffmpeg", "-v", "error", "-f", "f32le", "-ac", str(audio.shape[1]),
+               "-ar", str(sample_rate), "-i", "pipe:0",
+               "-c:a", "libopus", "-b:a", Config.MEDIA_OPUS_BITRATE, "-f", "ogg", "pipe:1"]
+    return subprocess.run(command, input=audio.tobytes(), capture_output=True, check=True).stdout
+
+
+def message_media(message):
+    """The audio-bearing media of a message, or None"""
+    if message is None:
+        return None
+    return message.voice or message.audio or message.video_note or message.video or message.document
+
+
+class MediaJob:
+    """One conversion travelling through the media pipeline"""
+
+    def __init__(self, message, character):
+        self.message = message
+        self.character = character
+        sender = getattr(message, "from_user", None)
+        self.user = sender.id if sender else message.chat.id
+        self.data = None
+        self.result = None
+        self.timings = {}
+        self.done = asyncio.get_running_loop().create_future()
+
+    def cleanup(self):
+        """Drop downloaded data (and its temporary file)"""
+        if isinstance(self.data, str):
+            try:
+                os.remove(self.data)
+            except OSError:
+                pass
+        self.data = None
+
+
+class MediaPipeline:
+    """download → DSP → upload, connected by bounded asyncio queues
+
+    Every stage has its own workers, so the next message downloads while the
+    current one is being processed and the previous one uploads. The queue
+    bounds give backpressure: when DSP falls behind, downloads wait instead
+    of piling media up in memory.
+    """
+
+    STAGES = ("download", "process", "upload")
+
+    def __init__(self, client, process, concurrency=None, queue_size=Config.MEDIA_QUEUE_SIZE):
+        self.client = client
+        self.process = process
+        self.concurrency = dict(Config.MEDIA_CONCURRENCY, **(concurrency or {}))
+        self.queues = {stage: asyncio.Queue(maxsize=queue_size) for stage in self.STAGES}
+        self._tasks = []
+
+    def start(self):
+        depth = metrics.gauge("media_queue_depth", "Jobs waiting in front of each media pipeline stage",
+                              labels=("stage",))
+        for stage, queue in self.queues.items():
+            depth.labels(stage).fn = queue.qsize
+        
+        for index, stage in enumerate(self.STAGES):
+            following = self.queues[self.STAGES[index + 1]] if index + 1 < len(self.STAGES) else None
+            for _ in range(self.concurrency[stage]):
+                self._tasks.append(asyncio.create_task(self._worker(stage, following)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, message, character):
+        """Queue a conversion; await ``job.done`` for completion"""
+        job = MediaJob(message, character)
+        await self.queues["download"].put(job)
+        return job
+
+    def pending(self):
+        """Jobs waiting in front of each stage"""
+        return {stage: queue.qsize() for stage, queue in self.queues.items()}
+
+    async def _worker(self, stage, following):
+        queue = self.queues[stage]
+        run_stage = getattr(self, f"_{stage}")
+        while True:
+            job = await queue.get()
+            try:
+                started = time.perf_counter()
+                await run_stage(job)
+                elapsed = time.perf_counter() - started
+                job.timings[stage] = elapsed
+                MEDIA_STAGE_SECONDS.labels(stage).observe(elapsed)
                 
-            return processed
-            
-        except Exception as e:
-            logging.error(f"Character voice processing error: {e}")
-            return audio_data
-    
-    def pitch_shift(self, audio_data, factor):
-        """Advanced pitch shifting with quality preservation"""
-        if factor == 1.0:
-            return audio_data
-            
-        # Use phase vocoder approach for better quality
-        hop_length = 256
-        window_size = 1024
-        
-        # Simple resampling approach for real-time processing
-        new_length = int(len(audio_data) * factor)
-        if new_length > 0:
-            shifted = resample(audio_data, new_length)
-            
-            # Adjust length to match original
-            if len(shifted) < len(audio_data):
-                padded = np.zeros(len(audio_data))
-                padded[:len(shifted)] = shifted
-                return padded
-            else:
-                return shifted[:len(audio_data)]
-        return audio_data
-    
-    def formant_shift(self, audio_data, factor):
-        """Formant frequency shifting for voice character"""
-        if factor == 1.0:
-            return audio_data
-            
-        # Apply spectral envelope modification
-        # Simplified approach using filtering
-        nyquist = self.sample_rate / 2
-        
-        if factor > 1.0:
-            # Higher formants - brighter voice
-            low = 200 / nyquist
-            high = min(3000 * factor, nyquist - 100) / nyquist
-            b, a = butter(4, [low, high], btype='band')
-            return filtfilt(b, a, audio_data)
+                if following is not None:
+                    await following.put(job)
+                else:
+                    MEDIA_JOBS_TOTAL.labels("ok").inc()
+                    job.done.set_result(job)
+            except Exception as e:
+                logging.error(f"Media {stage} error: {e}")
+                MEDIA_JOBS_TOTAL.labels("error").inc()
+                job.cleanup()
+                if not job.done.done():
+                    job.done.set_exception(e)
+            finally:
+                queue.task_done()
+
+    async def _download(self, job):
+        media = message_media(job.message)
+        if (getattr(media, "file_size", 0) or 0) <= Config.MEDIA_MEMORY_LIMIT:
+            buffer = await self.client.download_media(job.message, in_memory=True)
+            job.data = buffer.getvalue()
         else:
-            # Lower formants - deeper voice
-            cutoff = min(2000 * factor, nyquist - 100) / nyquist
-            b, a = butter(4, cutoff, btype='low')
-            return filtfilt(b, a, audio_data)
-    
-    def apply_nasal_effect(self, audio_data):
-        """Squidward's nasal effect"""
-        # Emphasize nasal frequencies (1000-2000 Hz)
-        nyquist = self.sample_rate / 2
-        low = 1000 / nyquist
-        high = 2000 / nyquist
-        b, a = butter(2, [low, high], btype='band')
-        filtered = filtfilt(b, a, audio_data)
-        return audio_data + 0.3 * filtered
-    
-    def apply_excitement_effect(self, audio_data):
-        """SpongeBob's excited effect"""
-        # Add slight tremolo and boost high frequencies
-        t = np.arange(len(audio_data)) / self.sample_rate
-        tremolo = 1 + 0.1 * np.sin(2 * np.pi * 5 * t)  # 5 Hz tremolo
-        
-        # High frequency boost
-        nyquist = self.sample_rate / 2
-        cutoff = 2000 / nyquist
-        b, a = butter(2, cutoff, btype='high')
-        high_boost = filtfilt(b, a, audio_data)
-        
-        return (audio_data + 0.2 * high_boost) * tremolo
-    
-    def apply_authority_effect(self, audio_data):
-        """Jokowi's authoritative effect"""
-        # Boost low-mid frequencies for authority
-        nyquist = self.sample_rate / 2
-        low = 150 / nyquist  
-        high = 800 / nyquist
-        b, a = butter(3, [low, high], btype='band')
-        filtered = filtfilt(b, a, audio_data)
-        return audio_data + 0.25 * filtered
-    
-    def apply_warmth_effect(self, audio_data):
-        """Ganjar's friendly warmth effect"""
-        # Gentle low-frequency warmth
-        nyquist = self.sample_rate / 2
-        cutoff = 500 / nyquist
-        b, a = butter(2, cutoff, btype='low')
-        warm = filtfilt(b, a, audio_data)
-        return audio_data + 0.15 * warm
-    
-    def apply_energy_effect(self, audio_data):
-        """Clara's energetic effect"""
-        # Brightness and slight compression
-        nyquist = self.sample_rate / 2
-        cutoff = 1500 / nyquist
-        b, a = butter(2, cutoff, btype='high')
-        bright = filtfilt(b, a, audio_data)
-        
-        # Simple compression effect
-        threshold = 0.3
-        compressed = np.where(np.abs(audio_data) > threshold,
-                            threshold + (audio_data - threshold) * 0.5,
-                            audio_data)
-        
-        return compressed + 0.2 * bright
-    
-    def audio_callback(self, indata, outdata, frames, time, status):
-        """Real-time audio processing callback"""
-        if status:
-            logging.warning(f"Audio status: {status}")
+            # Large files go to disk; ffmpeg reads them from there
+            path = Path(tempfile.gettempdir()) / f"voiceclone-{job.message.chat.id}-{job.message.id}"
+            job.data = await self.client.download_media(job.message, file_name=str(path))
+
+    async def _process(self, job):
+        loop = asyncio.get_running_loop()
+        try:
+            job.result = await loop.run_in_executor(None, self.process, job)
+            CONVERSIONS_TOTAL.labels(job.character).inc()
+        finally:
+            job.cleanup()
+
+    async def _upload(self, job):
+        voice = io.BytesIO(job.result)
+        voice.name = f"{job.character}.ogg"
+        await self.client.send_voice(job.message.chat.id, voice, reply_to_message_id=job.message.id)
+        job.result = None
+
+
+def convert_media(job, library=None):
+    """Pipeline DSP stage: decode, render through the character, encode as a voice note"""
+    audio = decode_audio(job.data)
+    profile = voice_profiles.update(job.user, audio)
+    output, _ = render_character(audio, job.character, stretch=True, profile=profile, flush=True,
+                                 library=library)
+    return encode_voice(output)
+
+# ================================
+# SPEECH SYNTHESIS
+# ================================
+
+class TTSBackend(ABC):
+    """Offline text-to-speech backend: ``synthesize(text)`` returns float32 (frames, 1)"""
+
+    name = "base"
+
+    def __init__(self, sample_rate=Config.SAMPLE_RATE):
+        self.sample_rate = sample_rate
+
+    @abstractmethod
+    def synthesize(self, text):
+        """Render ``text`` at ``sample_rate``"""
+
+
+def _phone(formants, voice=1.0, noise=0.0, ms=110, amplitude=1.0):
+    return {"formants": formants, "voice": voice, "noise": noise, "ms": ms, "amplitude": amplitude}
+
+
+def _plosive(burst, voiced):
+    """Closure followed by a noise burst (voiced plosives keep a voice bar in the closure)"""
+    closure = _phone(((250, 100), (1000, 200), (2500, 300)), voice=0.15 if voiced else 0.0,
+                     ms=50, amplitude=0.1 if voiced else 0.0)
+    return [closure, _phone(burst, voice=0.3 if voiced else 0.0, noise=1.0, ms=20, amplitude=0.5)]
+
+
+class FormantSynthesizer(TTSBackend):
+    """Rule-based cascade formant synthesizer (letter-to-sound, no voice data)
+
+    Letters map almost one-to-one to phones, which suits phonetic spellings
+    (Indonesian, Spanish, ...) best. A glottal pulse train with a falling
+    pitch contour, mixed with noise for fricatives and bursts, runs through
+    three resonators per phone with the filter state carried across phone
+    boundaries.
+    """
+
+    name = "formant"
+
+    VOWEL = {
+        "a": ((730, 90), (1090, 110), (2440, 170)),
+        "e": ((530, 80), (1840, 100), (2480, 160)),
+        "i": ((270, 60), (2290, 100), (3010, 200)),
+        "o": ((570, 80), (840, 100), (2410, 160)),
+        "u": ((300, 60), (870, 100), (2240, 160)),
+    }
+    NASAL = ((280, 60), (1000, 200), (2300, 250))
+    PHONES = {
+        **{vowel: [_phone(formants)] for vowel, formants in VOWEL.items()},
+        "y": [_phone(VOWEL["i"], ms=55)],
+        "w": [_phone(VOWEL["u"], ms=55)],
+        "m": [_phone(((280, 60), (900, 200), (2200, 250)), ms=70, amplitude=0.45)],
+        "n": [_phone(((280, 60), (1700, 200), (2600, 250)), ms=70, amplitude=0.45)],
+        "ng": [_phone(NASAL, ms=80, amplitude=0.45)],
+        "l": [_phone(((360, 80), (1300, 120), (2700, 200)), ms=65, amplitude=0.6)],
+        "r": [_phone(((420, 80), (1300, 120), (1600, 150)), ms=65, amplitude=0.6)],
+        "s": [_phone(((4500, 800), (6000, 1000), (7500, 1000)), voice=0.0, noise=1.0, ms=100, amplitude=0.35)],
+        "z": [_phone(((4500, 800), (6000, 1000), (7500, 1000)), voice=0.4, noise=1.0, ms=90, amplitude=0.35)],
+        "sh": [_phone(((2500, 500), (3500, 700), (5500, 1000)), voice=0.0, noise=1.0, ms=110, amplitude=0.4)],
+        "f": [_phone(((1400, 900), (4000, 1500), (7000, 2000)), voice=0.0, noise=1.0, ms=90, amplitude=0.15)],
+        "v": [_phone(((1400, 900), (4000, 1500), (7000, 2000)), voice=0.5, noise=1.0, ms=80, amplitude=0.2)],
+        "h": [_phone(((600, 300), (1500, 400), (2500, 500)), voice=0.0, noise=1.0, ms=60, amplitude=0.2)],
+        "p": _plosive(((800, 400), (1500, 500), (2500, 600)), voiced=False),
+        "b": _plosive(((800, 400), (1500, 500), (2500, 600)), voiced=True),
+        "t": _plosive(((3500, 800), (4500, 800), (6000, 1000)), voiced=False),
+        "d": _plosive(((3500, 800), (4500, 800), (6000, 1000)), voiced=True),
+        "k": _plosive(((1800, 500), (2500, 600), (3500, 800)), voiced=False),
+        "g": _plosive(((1800, 500), (2500, 600), (3500, 800)), voiced=True),
+    }
+    ALIASES = {"c": ["t", "sh"], "j": ["d", "z"], "q": ["k"], "x": ["k", "s"], "th": ["f"], "ch": ["t", "sh"]}
+    PAUSES_MS = {" ": 70, ",": 180, ";": 180, ":": 180, ".": 320, "!": 320, "?": 320, "\n": 320}
+
+    def __init__(self, sample_rate=Config.SAMPLE_RATE, f0=Config.TTS_F0, seed=0):
+        super().__init__(sample_rate)
+        self.f0 = f0
+        self.seed = seed
+
+    def phones(self, text):
+        """Letter-to-sound: list of phone dicts and pause markers (ms as int)"""
+        text = text.lower()
+        result = []
+        i = 0
+        while i < len(text):
+            pair = text[i:i + 2]
+            if pair in self.PHONES or pair in self.ALIASES:
+                symbols, i = [pair], i + 2
+            else:
+                symbols, i = [text[i]], i + 1
+            for symbol in symbols:
+                for name in self.ALIASES.get(symbol, [symbol]):
+                    if name in self.PHONES:
+                        result.extend(self.PHONES[name])
+                    elif name in self.PAUSES_MS:
+                        result.append(self.PAUSES_MS[name])
+        return result
+
+    def _resonators(self, formants):
+        """Cascade of unity-DC-gain two-pole resonators as second-order sections"""
+        sos = np.zeros((len(formants), 6))
+        for row, (frequency, bandwidth) in zip(sos, formants):
+            frequency = min(frequency, 0.45 * self.sample_rate)
+            radius = np.exp(-np.pi * bandwidth / self.sample_rate)
+            a1 = -2 * radius * np.cos(2 * np.pi * frequency / self.sample_rate)
+            a2 = radius * radius
+            row[:] = (1 + a1 + a2, 0, 0, 1, a1, a2)
+        return sos
+
+    def synthesize(self, text):
+        sr = self.sample_rate
+        phones = self.phones(text)
+        lengths = [int((item if isinstance(item, int) else item["ms"]) * sr / 1000) for item in phones]
+        total = sum(lengths)
+        if not total:
+            return np.zeros((0, 1), dtype=np.float32)
+        
+        # Pitch falls across the utterance (and rises at the end of a question)
+        position = np.linspace(0.0, 1.0, total)
+        f0 = self.f0 * (1.1 - 0.25 * position)
+        if text.rstrip().endswith("?"):
+            f0 *= 1.0 + 0.4 * np.clip((position - 0.8) / 0.2, 0.0, 1.0)
+        # Glottal pulses with a -12 dB/octave tilt
+        cycles = np.cumsum(f0 / sr)
+        pulses = np.diff(np.floor(cycles), prepend=0.0)
+        glottal = sosfilt(butter(2, 700 / (sr / 2), output="sos"), pulses)
+        noise = np.random.default_rng(self.seed).standard_normal(total)
+        
+        output = np.zeros(total)
+        ramp = int(0.008 * sr)
+        zi = np.zeros((3, 2))
+        start = 0
+        for item, length in zip(phones, lengths):
+            stop = start + length
+            if not isinstance(item, int) and item["amplitude"] > 0:
+                excitation = item["voice"] * glottal[start:stop] + 0.05 * item["noise"] * noise[start:stop]
+                segment, zi = sosfilt(self._resonators(item["formants"]), excitation, zi=zi)
+                rms = np.sqrt(np.mean(segment ** 2))
+                if rms > 0:
+                    segment *= 0.1 * item["amplitude"] / rms
+                edge = min(ramp, length // 2)
+                if edge:
+                    segment[:edge] *= np.linspace(0.0, 1.0, edge)
+                    segment[-edge:] *= np.linspace(1.0, 0.0, edge)
+                output[start:stop] = segment
+            start = stop
         
+        peak = np.max(np.abs(output))
+        if peak > 0:
+            output *= 0.5 / peak
+        return output.astype(np.float32)[:, None]
+
+
+TTS_BACKENDS = {"formant": FormantSynthesizer}
+
+
+class SpeechCache:
+    """LRU cache of encoded character speech keyed by (text, character, chain hash)"""
+
+    def __init__(self, max_entries=Config.SAY_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+        SPEECH_CACHE_TOTAL.labels("hit" if data is not None else "miss").inc()
+        return data
+
+    def put(self, key, data):
+        with self._lock:
+            self._entries[key] = data
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def synthesize_character(text, character, backend, library=None):
+    """Speak ``text`` with ``backend``, render it through the character, encode as a voice note"""
+    speech = backend.synthesize(text)
+    output, _ = render_character(speech, character, stretch=True, flush=True, library=library)
+    return encode_voice(output)
+
+# ================================
+# PROFILING
+# ================================
+
+def thread_cpu_times():
+    """CPU seconds per OS thread of this process: {native_id: (name, seconds)}"""
+    names = {thread.native_id: thread.name for thread in threading.enumerate()}
+    ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+    times = {}
+    try:
+        task_ids = os.listdir("/proc/self/task")
+    except OSError:
+        return times
+    for task_id in task_ids:
         try:
-            with self.processing_lock:
-                # Convert to mono
-                mono_input = indata[:, 0] if len(indata.shape) > 1 else indata
-                
-                # Apply character voice transformation
-                processed = self.apply_character_voice(mono_input, self.current_character)
-                
-                # Prevent clipping
-                processed = np.clip(processed, -0.95, 0.95)
-                
-                # Output
-                outdata[:, 0] = processed
-                
-        except Exception as e:
-            logging.error(f"Audio callback error: {e}")
-            outdata[:] = indata  # Fallback to original
+            with open(f"/proc/self/task/{task_id}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # Fields after the parenthesised command name; utime/stime are 14 and 15
+        comm = stat[stat.index("(") + 1:stat.rindex(")")]
+        fields = stat[stat.rindex(")") + 2:].split()
+        native_id = int(task_id)
+        times[native_id] = (names.get(native_id, comm), (int(fields[11]) + int(fields[12])) / ticks)
+    return times
+
+
+class SamplingProfiler:
+    """Samples every Python thread's stack into flamegraph collapsed-stack counts"""
+
+    def __init__(self, interval=Config.PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return f"{getattr(code, 'co_qualname', code.co_name)} ({Path(code.co_filename).name})"
+
+    def _sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame).replace(";", ":"))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}").replace(" ", "_"))
+            key = ";".join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def write_collapsed(self, path):
+        """Write ``stack count`` lines (flamegraph.pl / speedscope compatible)"""
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+
+async def profile_process(engine, seconds, output_dir=Config.PROFILE_DIR):
+    """Profile the whole process for ``seconds``; returns (summary text, collapsed-stack path)"""
+    loop = asyncio.get_running_loop()
+    chains = dict(engine.chains)
+    stage_before = {key: list(chain.stage_time) for key, chain in chains.items()}
+    cpu_before = thread_cpu_times()
+    blocks_before = engine.gate.blocks if engine.gate else 0
+    skipped_before = engine.gate.skipped if engine.gate else 0
     
-    def start_voice_clone(self, character="normal"):
-        """Start real-time voice cloning"""
-        if self.is_active:
-            self.stop_voice_clone()
-            
-        try:
-            self.current_character = character
-            self.is_active = True
-            
-            # Start audio streams
-            with sd.InputStream(callback=self.audio_callback,
-                              channels=1,
-                              samplerate=self.sample_rate,
-                              blocksize=self.buffer_size):
-                with sd.OutputStream(callback=self.audio_callback,
-                                   channels=1,
-                                   samplerate=self.sample_rate,
-                                   blocksize=self.buffer_size):
-                    
-                    logging.info(f"Voice clone started with character: {character}")
-                    
-                    # Keep streams alive
-                    while self.is_active:
-                        sd.sleep(100)
-                        
-        except Exception as e:
-            logging.error(f"Voice clone start error: {e}")
-            self.is_active = False
-            
-    def stop_voice_clone(self):
-        """Stop voice cloning"""
-        self.is_active = False
-        logging.info("Voice clone stopped")
+    profiler = SamplingProfiler()
+    profiler.start()
+    
+    # Event-loop lag at a finer grain than the background monitor
+    lags = []
+    step = 0.05
+    started = loop.time()
+    while loop.time() - started < seconds:
+        before = loop.time()
+        await asyncio.sleep(step)
+        lags.append(max(0.0, loop.time() - before - step))
+    wall = loop.time() - started
+    
+    await loop.run_in_executor(None, profiler.stop)
+    cpu_after = thread_cpu_times()
+    
+    path = Path(output_dir) / f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded"
+    profiler.write_collapsed(path)
+    
+    lags_ms = np.array(lags) * 1000
+    text = (f"🔬 **Profile ({wall:.1f} s, {profiler.samples} samples)**\n\n"
+            f"**Event loop lag:** p50 {np.percentile(lags_ms, 50):.1f} ms, "
+            f"p99 {np.percentile(lags_ms, 99):.1f} ms, max {lags_ms.max():.1f} ms\n")
+    
+    text += "\n**Thread CPU:**\n"
+    usage = []
+    for native_id, (name, after) in cpu_after.items():
+        before = cpu_before.get(native_id, (name, 0.0))[1]
+        usage.append((after - before, name))
+    for seconds_used, name in sorted(usage, reverse=True)[:6]:
+        if seconds_used > 0:
+            text += f"• `{name}` {seconds_used / wall:.0%}\n"
+    
+    for key, chain in chains.items():
+        spent = [after - before for after, before in zip(chain.stage_time, stage_before[key])]
+        total = sum(spent)
+        if total <= 0:
+            continue
+        text += f"\n**Stages ({key}, {total / wall:.1%} of wall time):**\n"
+        for stage, share in zip(chain.stages, spent):
+            text += f"• {type(stage).__name__} {share / total:.0%}\n"
+    
+    if engine.gate:
+        blocks = engine.gate.blocks - blocks_before
+        skipped = engine.gate.skipped - skipped_before
+        if blocks:
+            text += f"\nGate skipped {skipped}/{blocks} blocks\n"
+    
+    return text, path
 
 # ================================
 # TELEGRAM SESSION MANAGER
@@ -407,8 +4282,14 @@ class SessionManager:
 class VoiceCloneUserBot:
     def __init__(self):
         self.voice_engine = VoiceCloneEngine()
+        self.voice_engine.register_metrics()
         self.session_manager = SessionManager()
         self.client = None
+        self.metrics_server = None
+        self.loop_monitor = None
+        self.media_pipeline = None
+        self.tts = TTS_BACKENDS[Config.TTS_BACKEND]()
+        self.speech_cache = SpeechCache()
         
         # Setup logging
         logging.basicConfig(
@@ -435,6 +4316,22 @@ class VoiceCloneUserBot:
         print("=" * 50)
         
         self.setup_handlers()
+        
+        library = self.voice_engine.library
+        self.media_pipeline = MediaPipeline(self.client, lambda job: convert_media(job, library))
+        self.media_pipeline.start()
+        
+        # Apply character file edits live
+        self.voice_engine.library.start_watching(self.voice_engine.reload_characters)
+        
+        # Local metrics endpoint and event-loop lag sampling
+        if Config.METRICS_ENABLED:
+            try:
+                self.metrics_server = MetricsServer(metrics)
+                self.metrics_server.start()
+            except OSError as e:
+                logging.error(f"Metrics server error: {e}")
+            self.loop_monitor = asyncio.create_task(monitor_event_loop())
         return True
     
     def setup_handlers(self):
@@ -451,52 +4348,112 @@ class VoiceCloneUserBot:
                                      "`.voice start <character>` - Start voice clone\n"
                                      "`.voice stop` - Stop voice clone\n"
                                      "`.voice list` - List characters\n"
+                                     "`.voice reload` - Reload character files\n"
+                                     "`.voice sink <pipe PATH|device NAME|off>` - Extra outputs\n"
                                      "`.voice status` - Show status")
                     return
                 
                 if args[0] == "start":
                     character = args[1] if len(args) > 1 else "normal"
                     
-                    if character not in ["normal"] + list(Config.VOICE_CHARACTERS.keys()):
+                    if character not in ["normal"] + list(self.voice_engine.characters.keys()):
                         await message.edit(f"❌ Character '{character}' not found!\n"
-                                         f"Available: {', '.join(['normal'] + list(Config.VOICE_CHARACTERS.keys()))}")
+                                         f"Available: {', '.join(['normal'] + list(self.voice_engine.characters.keys()))}")
                         return
                     
-                    # Start voice clone in background thread
-                    def start_clone():
-                        self.voice_engine.start_voice_clone(character)
+                    if self.voice_engine.is_active:
+                        await message.edit("⚠️ Voice clone already active!")
+                        return
                     
-                    if not self.voice_engine.is_active:
-                        threading.Thread(target=start_clone, daemon=True).start()
-                        
-                        char_name = Config.VOICE_CHARACTERS.get(character, {}).get("name", character)
+                    if await self.voice_engine.start(character):
+                        char_name = self.voice_engine.characters.get(character, {}).get("name", character)
                         await message.edit(f"🎭 **Voice Clone Started!**\n"
                                          f"Character: **{char_name}**\n"
                                          f"Status: **Active** ✅")
                     else:
-                        await message.edit("⚠️ Voice clone already active!")
+                        await message.edit("❌ Could not open the audio stream (see logs)")
                 
                 elif args[0] == "stop":
-                    self.voice_engine.stop_voice_clone()
+                    await self.voice_engine.stop()
                     await message.edit("🛑 **Voice Clone Stopped!**")
                 
                 elif args[0] == "list":
                     char_list = "🎭 **Available Characters:**\n\n"
-                    for key, info in Config.VOICE_CHARACTERS.items():
+                    for key, info in self.voice_engine.characters.items():
                         char_list += f"• `{key}` - {info['name']}\n"
                     char_list += f"• `normal` - Original Voice"
                     await message.edit(char_list)
                 
                 elif args[0] == "status":
                     status = "Active ✅" if self.voice_engine.is_active else "Inactive ❌"
-                    char_name = Config.VOICE_CHARACTERS.get(
+                    char_name = self.voice_engine.characters.get(
                         self.voice_engine.current_character, {}
                     ).get("name", self.voice_engine.current_character)
                     
-                    await message.edit(f"🎤 **Voice Clone Status:**\n\n"
-                                     f"Status: **{status}**\n"
-                                     f"Character: **{char_name}**\n"
-                                     f"Sample Rate: {Config.SAMPLE_RATE} Hz")
+                    text = (f"🎤 **Voice Clone Status:**\n\n"
+                            f"Status: **{status}**\n"
+                            f"Character: **{char_name}**\n"
+                            f"Sample Rate: {Config.SAMPLE_RATE} Hz")
+                    
+                    chain = self.voice_engine.chains.get(self.voice_engine.current_character)
+                    warper = chain.find_stage(FormantWarper) if chain else None
+                    if warper is not None:
+                        text += (f"\nFormant: {warper.method} "
+                                 f"({warper.cost_per_frame_us:.0f} µs/frame)")
+                    
+                    engine = self.voice_engine
+                    text += (f"\nBlock: {engine.buffer_size} "
+                             f"({engine.buffer_size / engine.sample_rate * 1000:.1f} ms)"
+                             f"{' auto' if Config.AUTO_TUNE else ''}")
+                    if engine.stream_latency is not None:
+                        text += f", latency {engine.stream_latency * 1000:.1f} ms"
+                    text += f"\nLoad: {engine.tuner.load:.0%}, xruns {engine.tuner.xruns}"
+                    
+                    gate = self.voice_engine.gate
+                    if gate is not None:
+                        text += (f"\nGate: {'open' if gate.is_open else 'closed'} "
+                                 f"({gate.level_db:.0f} dB, {gate.idle_ratio:.0%} idle)")
+                    
+                    meter = engine.normalizer.meter
+                    if np.isfinite(meter.short_term):
+                        text += (f"\nLoudness: {meter.short_term:.1f} LUFS short-term, "
+                                 f"makeup {engine.normalizer.gain_db:+.1f} dB")
+                    
+                    await message.edit(text)
+                
+                elif args[0] == "sink":
+                    engine = self.voice_engine
+                    if len(args) >= 3 and args[1] == "pipe":
+                        sink = engine.add_sink(PipeSink(engine.sink_ring, args[2]))
+                        await message.edit(f"🔌 Sink added: `{sink.describe()}`")
+                    elif len(args) >= 3 and args[1] == "device":
+                        device = int(args[2]) if args[2].isdigit() else " ".join(args[2:])
+                        sink = engine.add_sink(SoundDeviceSink(engine.sink_ring, device,
+                                                               sample_rate=engine.sample_rate,
+                                                               blocksize=engine.buffer_size))
+                        await message.edit(f"🔌 Sink added: `{sink.describe()}`")
+                    elif len(args) >= 2 and args[1] == "off":
+                        removed = engine.remove_sinks()
+                        await message.edit(f"🔌 Removed {len(removed)} sink(s)")
+                    else:
+                        text = "🔌 **Output Sinks:**\n\n"
+                        for sink in engine.sinks:
+                            text += (f"• `{sink.describe()}` - backlog {sink.reader.backlog}, "
+                                     f"dropped {sink.dropped}\n")
+                        if not engine.sinks:
+                            text += "• Default device only"
+                        await message.edit(text)
+                
+                elif args[0] == "reload":
+                    keys = await asyncio.get_running_loop().run_in_executor(
+                        None, self.voice_engine.reload_characters)
+                    library = self.voice_engine.library
+                    text = (f"🔄 **Characters Reloaded!**\n"
+                            f"Loaded: {len(library.characters)}\n"
+                            f"Changed: {', '.join(sorted(keys)) or 'none'}")
+                    for name, error in library.errors.items():
+                        text += f"\n❌ `{name}`: {error}"
+                    await message.edit(text)
                 
             except Exception as e:
                 await message.edit(f"❌ Error: {str(e)}")
@@ -511,13 +4468,143 @@ class VoiceCloneUserBot:
                 return
             
             character = args[0]
-            if character in Config.VOICE_CHARACTERS:
+            if character in self.voice_engine.characters:
+                self.voice_engine.get_chain(character)
                 self.voice_engine.current_character = character
-                char_name = Config.VOICE_CHARACTERS[character]["name"]
+                char_name = self.voice_engine.characters[character]["name"]
                 await message.edit(f"🎭 Switched to: **{char_name}**", delete_in=3)
             else:
                 await message.edit(f"❌ Character not found: {character}", delete_in=3)
         
+        @self.client.on_message(filters.command("convert") & filters.me)
+        async def convert_command(client, message):
+            """Convert a replied-to voice message or audio file"""
+            try:
+                args = message.text.split()[1:] if len(message.text.split()) > 1 else []
+                
+                if not args:
+                    await message.edit("❌ Usage: `.convert <character>` (reply to a voice message or audio file)")
+                    return
+                
+                character = args[0].lower()
+                if character != "normal" and character not in self.voice_engine.characters:
+                    await message.edit(f"❌ Character '{character}' not found!")
+                    return
+                
+                source = message.reply_to_message
+                if message_media(source) is None:
+                    await message.edit("❌ Reply to a voice message or audio file")
+                    return
+                
+                name = self.voice_engine.characters[character]["name"] if character != "normal" else "Normal"
+                pending = sum(self.media_pipeline.pending().values())
+                await message.edit(f"⏳ Converting to **{name}**" + (f" ({pending} ahead)" if pending else "") + "...")
+                
+                job = await self.media_pipeline.submit(source, character)
+                await job.done
+                
+                timings = " | ".join(f"{stage} {seconds:.1f}s" for stage, seconds in job.timings.items())
+                text = f"✅ Converted to **{name}**\n⏱️ {timings}"
+                profile = voice_profiles.get(job.user)
+                if profile is not None and profile.median_f0:
+                    state = "active" if profile.ready else "learning"
+                    text += f"\n👤 Profile ({state}): {profile.median_f0:.0f} Hz, {profile.seconds:.0f} s"
+                await message.edit(text)
+                
+            except Exception as e:
+                await message.edit(f"❌ Error: {str(e)}")
+        
+        @self.client.on_message(filters.command("say") & filters.me)
+        async def say_command(client, message):
+            """Speak text in a character voice"""
+            try:
+                parts = message.text.split(maxsplit=2)
+                if len(parts) < 3:
+                    await message.edit("❌ Usage: `.say <character> <text>`")
+                    return
+                
+                character = parts[1].lower()
+                text = " ".join(parts[2].split())[:Config.SAY_MAX_CHARS]
+                spec = self.voice_engine.characters.get(character)
+                if character != "normal" and spec is None:
+                    await message.edit(f"❌ Character '{character}' not found!")
+                    return
+                
+                # The chain hash keeps edited characters from serving stale audio
+                compiler = self.voice_engine.compiler
+                chain_key = compiler.plan_hash(compiler.plan(spec)) if spec else "normal"
+                key = (text.lower(), character, chain_key)
+                
+                voice_data = self.speech_cache.get(key)
+                if voice_data is None:
+                    await message.edit("🗣️ Synthesizing...")
+                    loop = asyncio.get_running_loop()
+                    voice_data = await loop.run_in_executor(None, synthesize_character,
+                                                            text, character, self.tts,
+                                                            self.voice_engine.library)
+                    CONVERSIONS_TOTAL.labels(character).inc()
+                    self.speech_cache.put(key, voice_data)
+                
+                voice = io.BytesIO(voice_data)
+                voice.name = f"{character}.ogg"
+                await client.send_voice(message.chat.id, voice,
+                                        reply_to_message_id=message.reply_to_message_id)
+                await message.delete()
+                
+            except Exception as e:
+                await message.edit(f"❌ Error: {str(e)}")
+        
+        @self.client.on_message(filters.command("profile") & filters.me)
+        async def profile_command(client, message):
+            """Show or reset the voice profile of the replied-to user (or your own)"""
+            try:
+                args = message.text.split()[1:] if len(message.text.split()) > 1 else []
+                source = message.reply_to_message
+                sender = source.from_user if source and source.from_user else message.from_user
+                
+                if args and args[0] == "reset":
+                    voice_profiles.reset(sender.id)
+                    await message.edit(f"🗑️ Voice profile of {sender.first_name} deleted")
+                    return
+                
+                profile = voice_profiles.get(sender.id)
+                if profile is None or profile.median_f0 is None:
+                    await message.edit(f"👤 No voice profile for {sender.first_name} yet "
+                                     f"(built from `.convert`)")
+                    return
+                
+                await message.edit(f"👤 **Voice profile: {sender.first_name}**\n\n"
+                                 f"Median F0: {profile.median_f0:.0f} Hz\n"
+                                 f"Envelope centroid: {profile.centroid:.0f} Hz\n"
+                                 f"Loudness: {profile.loudness_db:.1f} dB\n"
+                                 f"Voiced audio: {profile.seconds:.0f} s "
+                                 f"({'active' if profile.ready else 'learning'})")
+                
+            except Exception as e:
+                await message.edit(f"❌ Error: {str(e)}")
+        
+        @self.client.on_message(filters.command("debug") & filters.me)
+        async def debug_command(client, message):
+            """Debugging tools"""
+            try:
+                args = message.text.split()[1:] if len(message.text.split()) > 1 else []
+                
+                if not args or args[0] != "profile":
+                    await message.edit("🔬 **Debug Commands:**\n\n"
+                                     "`.debug profile <seconds>` - Sample threads, loop lag and DSP stages")
+                    return
+                
+                seconds = float(args[1]) if len(args) > 1 else 10.0
+                seconds = min(max(seconds, 1.0), Config.PROFILE_MAX_SECONDS)
+                await message.edit(f"🔬 Profiling for {seconds:.0f} s...")
+                
+                text, path = await profile_process(self.voice_engine, seconds)
+                await message.edit(text)
+                await message.reply_document(str(path), caption="🔥 Collapsed stacks (flamegraph.pl / speedscope)")
+                
+            except Exception as e:
+                await message.edit(f"❌ Error: {str(e)}")
+        
         @self.client.on_message(filters.command("session") & filters.me)
         async def session_command(client, message):
             """Session management command"""
@@ -573,7 +4660,13 @@ class VoiceCloneUserBot:
             print("  .voice stop - Stop voice cloning")  
             print("  .voice list - List available characters")
             print("  .voice status - Show voice clone status")
+            print("  .voice reload - Reload character files")
+            print("  .voice sink <pipe PATH|device NAME|off> - Extra audio outputs")
             print("  .quick <character> - Quick character switch")
+            print("  .convert <character> - Convert the replied-to voice message")
+            print("  .profile [reset] - Show/reset a voice profile (reply to a user)")
+            print("  .say <character> <text> - Speak text in a character voice")
+            print("  .debug profile <seconds> - Profile loop lag, threads and DSP stages")
             print("  .session info - Show session information")
             print("  .session reset - Reset session (requires restart)")
             print("\n⚠️  Press Ctrl+C to stop")
@@ -583,7 +4676,8 @@ class VoiceCloneUserBot:
                 await self.client.idle()
             except KeyboardInterrupt:
                 print("\n👋 Shutting down...")
-                self.voice_engine.stop_voice_clone()
+                await self.voice_engine.stop()
+                await self.media_pipeline.stop()
                 await self.client.stop()
         else:
             print("❌ Failed to start userbot!")
@@ -597,7 +4691,120 @@ async def main():
     userbot = VoiceCloneUserBot()
     await userbot.run()
 
+def run_offline_tools(argv):
+    """Headless replay / regression commands (no Telegram, no sound card)"""
+    parser = argparse.ArgumentParser(description="Offline voice rendering tools")
+    parser.add_argument("--replay", metavar="INPUT", help="render INPUT (WAV or .f32) through a character")
+    parser.add_argument("--regress", metavar="INPUT", help="render INPUT through every character and compare with golden renders")
+    parser.add_argument("--character", default="normal")
+    parser.add_argument("--output", default="output.wav")
+    parser.add_argument("--golden", default="golden")
+    parser.add_argument("--update", action="store_true", help="re-record golden renders")
+    parser.add_argument("--tolerance", type=float, default=1e-4)
+    parser.add_argument("--blocksize", type=int, default=Config.BUFFER_SIZE)
+    parser.add_argument("--jitter", type=float, default=0.0, help="scheduling jitter in ms")
+    parser.add_argument("--channels", type=int, default=Config.CHANNELS)
+    parser.add_argument("--channel-mode", choices=("mono", "stereo"), default=Config.CHANNEL_MODE)
+    parser.add_argument("--bench-kernels", action="store_true",
+                        help="time every kernel backend; exits 1 if one differs from the NumPy "
+                             "reference by more than KERNEL_TOLERANCE (chain: --tolerance)")
+    parser.add_argument("--stretch", action="store_true",
+                        help="apply the speaking rate offline (changes the duration)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="render --replay in overlapping segments across N processes "
+                             "(0 = sequential; implies --stretch); with --regress, also check "
+                             "segmented renders against sequential ones")
+    args = parser.parse_args(argv)
+    
+    logging.basicConfig(level=logging.WARNING,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    
+    if args.bench_kernels:
+        failed = 0
+        for backend, results in benchmark_kernels().items():
+            for kernel, (micros, error) in results.items():
+                passed = error <= Config.KERNEL_TOLERANCE
+                failed += not passed
+                print(f"{'✅' if passed else '❌'} {backend:>6} {kernel:>13}: {micros:9.1f} µs/call, "
+                      f"max diff {error:.1e} (tolerance {Config.KERNEL_TOLERANCE:.0e})")
+        
+        # Whole-chain comparison on a short synthetic vowel
+        t = np.arange(Config.SAMPLE_RATE * 2) / Config.SAMPLE_RATE
+        source = (0.3 * np.sin(2 * np.pi * 140 * t) * (1 + 0.5 * np.sin(2 * np.pi * 3 * t)))[:, None]
+        character = args.character if args.character != "normal" else "clara"
+        renders = {}
+        for backend in KERNEL_BACKENDS:
+            set_kernel_backend(backend)
+            renders[backend], stats = render_character(source.astype(np.float32), character,
+                                                       blocksize=args.blocksize)
+            print(f"{backend:>6} {character:>13}: {stats['mean_ms']:9.2f} ms/block "
+                  f"(p99 {stats['p99_ms']:.2f} ms)")
+        reference = renders.pop("numpy")
+        for backend, output in renders.items():
+            error = float(np.max(np.abs(output - reference)))
+            passed = error <= args.tolerance
+            failed += not passed
+            print(f"{'✅' if passed else '❌'} {backend:>6} vs numpy: max diff {error:.1e} "
+                  f"(tolerance {args.tolerance:.0e})")
+        return 1 if failed else 0
+    
+    if args.replay and args.workers:
+        renderer = ParallelRenderer(workers=args.workers, blocksize=args.blocksize)
+        output, stats = renderer.render(args.replay, args.character,
+                                        channels=args.channels, channel_mode=args.channel_mode)
+        save_audio(args.output, output)
+        print(f"💾 Saved {args.output}")
+        print(f"⏱️  {stats['segments']} segments on {stats['workers']} workers in {stats['seconds']:.1f} s "
+              f"({stats['speed']:.1f}x realtime, {stats['overhead']:.0%} pre-roll overhead)")
+        return 0
+    
+    if args.replay:
+        output, stats = render_character(args.replay, args.character,
+                                         blocksize=args.blocksize, jitter_ms=args.jitter,
+                                         channels=args.channels, channel_mode=args.channel_mode,
+                                         stretch=args.stretch)
+        save_audio(args.output, output)
+        print(f"💾 Saved {args.output}")
+        print(f"⏱️  {stats['mean_ms']:.2f} ms/block (p99 {stats['p99_ms']:.2f} ms), "
+              f"load {stats['load']:.0%}, xruns {stats['xruns']}")
+        return 0
+    
+    results = run_regression(args.regress, args.golden, update=args.update,
+                             tolerance=args.tolerance, blocksize=args.blocksize)
+    failed = 0
+    for character, error in check_builtin_samples().items():
+        failed += error is not None
+        state = f"❌ {error}" if error else "✅ rendered"
+        print(f"{character:>12}: built-in impulse response from an empty samples directory {state}")
+    for character, result in results.items():
+        if result.get("recorded"):
+            state = "📝 recorded"
+        elif result["passed"]:
+            state = f"✅ max err {result['max_error']:.2e}"
+        else:
+            failed += 1
+            reason = result.get("reason") or f"max err {result['max_error']:.2e}"
+            state = f"❌ {reason}"
+        print(f"{character:>12}: {state} | {result['mean_ms']:.2f} ms/block, "
+              f"p99 {result['p99_ms']:.2f} ms, load {result['load']:.0%}")
+    
+    if args.workers:
+        for character, checks in check_parallel(args.regress, list(results), tolerance=args.tolerance,
+                                                blocksize=args.blocksize).items():
+            for remainder, result in checks.items():
+                if result["passed"]:
+                    state = f"✅ max err {result['max_error']:.2e}"
+                else:
+                    failed += 1
+                    reason = result.get("reason") or f"max err {result['max_error']:.2e}"
+                    state = f"❌ {reason}"
+                print(f"{character:>12}: segmented, {remainder:>5} sample remainder {state}")
+    return 1 if failed else 0
+
 if __name__ == "__main__":
+    if any(arg in ("--replay", "--regress", "--bench-kernels") for arg in sys.argv[1:]):
+        sys.exit(run_offline_tools(sys.argv[1:]))
+    
     try:
         # Check dependencies
         import pyrogram
@@ -257,8 +257,21 @@ check_and_restart() {
     fi
 }
 
+check_metrics() {
+    # In-process metrics endpoint (see Config.METRICS_PORT in main.py)
+    if ! METRICS=$(curl -sf --max-time 5 http://127.0.0.1:9464/metrics); then
+        log_message "⚠️  Metrics endpoint not responding"
+        return
+    fi
+    XRUNS=$(echo "$METRICS" | awk '/^voice_xruns_total /{print $2}')
+    LAG=$(echo "$METRICS" | awk '/^event_loop_lag_last_seconds /{print $2}')
+    RSS=$(echo "$METRICS" | awk '/^process_resident_memory_bytes /{print $2}')
+    log_message "📊 xruns=${XRUNS:-?} loop_lag=${LAG:-?}s rss=${RSS:-?}B"
+}
+
 # Run check
 check_and_restart
+check_metrics
 EOF
 
 chmod +x monitor_bot.sh